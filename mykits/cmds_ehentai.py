@@ -1,4 +1,7 @@
 #!/usr/bin/env python3
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
 from mylib.ex.console_app import *
 from mylib.sites import ehentai
 
@@ -51,17 +54,21 @@ def migrate_favorites(cookies, from_favorite, to_favorite, proxy, verbose):
             input('press enter to exit')
 
 
-def _sorted_path_of_hentai_at_home_downloaded_gallery(gallery_path, gallery_type=''):
+def _read_hentai_at_home_downloaded_gallery_info(gallery_path, gallery_type=''):
+    try:
+        return ehentai.parse_hentai_at_home_downloaded_gallery_info(gallery_path, gallery_type)
+    except (OSError, ValueError, zipfile.BadZipFile):
+        return None
+
+
+def _sorted_path_of_hentai_at_home_downloaded_gallery(gallery_path, info: dict):
     _unknown_ = '(unknown)'
     _various_ = '(various)'
 
-    info = ehentai.parse_hentai_at_home_downloaded_gallery_info(gallery_path, gallery_type)
-    if not info:
-        return None
     title = info['title']
     sanitized_title = fstk.sanitize_xu240(title)
-    artist = info['tags']['artist']
-    group = info['tags']['group']
+    artist = info['tags'].get('artist', [])
+    group = info['tags'].get('group', [])
     root_dir, name, ext = split_path_dir_base_ext(gallery_path, dir_ext=False)
 
     creators = artist or group or []
@@ -79,25 +86,62 @@ def _sorted_path_of_hentai_at_home_downloaded_gallery(gallery_path, gallery_type
 @apr.arg(an.src, nargs='*')
 @apr.true(an.v, an.verbose)
 @apr.true(an.D, apr.dst2opt(an.dry_run))
-@apr.map(an.src, verbose=an.verbose, dry_run=an.dry_run)
-def hath_sort(src: PathSourceType, *, verbose=False, dry_run=False):
-    """rename and sort galleries downloaded via H@H (Hentai at Home)"""
+@apr.opt(long_name='db', metavar='PATH', help='gallery metadata DB (SQLite) to look up before reading galleryinfo.txt')
+@apr.opt('k', 'workers', type=int, metavar='N', help='processes to read galleryinfo.txt (default: CPU count)')
+@apr.map(an.src, verbose=an.verbose, dry_run=an.dry_run, db_path='db', workers='workers')
+def hath_sort(src: PathSourceType, *, verbose=False, dry_run=False, db_path=None, workers=None):
+    """rename and sort galleries downloaded via H@H (Hentai at Home)
+
+    all galleries are scanned first (galleryinfo.txt read in a process pool), then moved folder by folder"""
+    timings = {}
+    t = time.perf_counter()
     dirs, files = resolve_path_to_dirs_files(src)
+    galleries = [(p, 'd') for p in dirs] + [(p, 'f') for p in files]
+    info_d = {}
+    db = ehentai.EHentaiDB(db_path) if db_path else None
+    try:
+        if db is not None:
+            name_info_d = {p: ehentai.parse_hentai_at_home_gallery_name(p) for p, _ in galleries}
+            known = db.get_many(d['gid'] for d in name_info_d.values() if 'gid' in d)
+            for p, d in name_info_d.items():
+                if d.get('gid') in known:
+                    info_d[p] = {**known[d['gid']], **d}
+        todo = [(p, gallery_type) for p, gallery_type in galleries if p not in info_d]
+        if workers == 1 or len(todo) < 2:
+            info_l = list(itertools.starmap(_read_hentai_at_home_downloaded_gallery_info, todo))
+        else:
+            with ProcessPoolExecutor(workers) as executor:
+                info_l = list(executor.map(_read_hentai_at_home_downloaded_gallery_info, *zip(*todo), chunksize=16))
+        info_d.update((p, info) for (p, _), info in zip(todo, info_l) if info)
+        if db is not None:
+            db.upsert([info for info in info_l if info and 'gid' in info])
+    finally:
+        if db is not None:
+            db.close()
+    timings['scan'] = time.perf_counter() - t
+
+    t = time.perf_counter()
     src_dst_l = []
-    [src_dst_l.append((src, _sorted_path_of_hentai_at_home_downloaded_gallery(src, 'd'))) for src in dirs]
-    [src_dst_l.append((src, _sorted_path_of_hentai_at_home_downloaded_gallery(src, 'f'))) for src in files]
-    for src, dst in src_dst_l:
-        if not dst and verbose:
-            print(f'# {src}')
-            continue
-        try:
-            if not dry_run:
-                fstk.move_as(src, dst)
-            if verbose:
-                print(f'* {dst} <- {src}')
-        except Exception as e:
-            if verbose:
-                print(f'! {src}: {repr(e)}')
+    for p, _ in galleries:
+        if p in info_d:
+            src_dst_l.append((p, _sorted_path_of_hentai_at_home_downloaded_gallery(p, info_d[p])))
+        elif verbose:
+            print(f'# {p}')
+    timings['plan'] = time.perf_counter() - t
+
+    def log_move(src, dst, error):
+        if not verbose:
+            return
+        if error:
+            print(f'! {src}: {repr(error)}')
+        else:
+            print(f'* {dst} <- {src}')
+
+    t = time.perf_counter()
+    fstk.move_by_plan(src_dst_l, dry_run=dry_run, callback=log_move)
+    timings['move'] = time.perf_counter() - t
+    if verbose:
+        print(f'@ {len(src_dst_l)} galleries, ' + ', '.join(f'{k} {v:.2f}s' for k, v in timings.items()))
 
 
 @apr.sub(apr.rename_underscore(), aliases=['rc'])
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
+import collections
+import io
+import sqlite3
 import traceback
 import zipfile
-from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED
 from pprint import pprint
 
 import PIL.Image
@@ -10,7 +14,7 @@ import filetype
 from humanize import naturaldelta, naturalsize
 from send2trash import send2trash
 
-from mylib.easy import logging
+from mylib.easy import logging, fingerprint
 from mylib.ex.console_app import *
 from mylib.wrapper import cwebp
 
@@ -18,6 +22,7 @@ PIXELS_BASELINE = 1280 * 1920
 MAX_Q = 80
 MIN_Q = 50
 MAX_COMPRESS = 0.667
+MANIFEST_FILENAME = '.webp_cvt_manifest.sqlite'
 
 apr = ArgumentParserRigger()
 an = apr.an
@@ -28,26 +33,126 @@ an.T = an.strict = ''
 
 class Counter:
     n = 0
+    encodes = 0
 
 
-def convert_adaptive(image_fp, counter: Counter = None, print_path_relative_to=None):
+class ConversionError(Exception):
+    """unexpected failure of converting an image, raised (instead of exiting) to be reported per file"""
+
+
+class ConversionManifest:
+    """what `auto_cvt` did to each file under a library root, in a SQLite file at the root,
+    keyed by relative path and stamped with file size & mtime, so unchanged files can be skipped by a stat"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.path = path_join(root, MANIFEST_FILENAME)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('create table if not exists manifest ('
+                                'path text primary key, size integer, mtime integer, hash text, '
+                                'status text, q real, scale real, result_size integer)')
+        self.uncommitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def get(self, path: str):
+        """(size, mtime_ns, hash, status, q, scale, result_size) or None"""
+        return self.connection.execute(
+            'select size, mtime, hash, status, q, scale, result_size from manifest where path=?',
+            (self.relpath(path),)).fetchone()
+
+    def put(self, path: str, st: os.stat_result, stats: dict):
+        """`stats` is from `convert_adaptive`"""
+        self.connection.execute(
+            'insert or replace into manifest (path, size, mtime, hash, status, q, scale, result_size) '
+            'values (?, ?, ?, ?, ?, ?, ?, ?)',
+            (self.relpath(path), st.st_size, st.st_mtime_ns, stats.get('hash'),
+             'error' if 'error' in stats else 'skip' if 'skip' in stats else 'converted',
+             stats.get('q'), stats.get('scale'), stats.get('size')))
+        self.uncommitted += 1
+        if self.uncommitted >= 1000:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def touch(self, path: str, st: os.stat_result):
+        self.connection.execute('update manifest set size=?, mtime=? where path=?',
+                                (st.st_size, st.st_mtime_ns, self.relpath(path)))
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.root)
+
+    def needs_convert(self, path: str, st: os.stat_result, retune_size: int = None):
+        """return False to skip, True to convert (also files failed last time), or the max size to re-tune with"""
+        row = self.get(path)
+        if not row:
+            return True
+        size, mtime, hash_, status, q, scale, result_size = row
+        if size != st.st_size or status == 'error':
+            return True
+        if mtime != st.st_mtime_ns:
+            if not hash_ or fingerprint.file_content_hash(path) != hash_:
+                return True
+            self.touch(path, st)
+        if retune_size and status == 'converted' and result_size and result_size > retune_size:
+            return retune_size
+        return False
+
+
+def convert_adaptive(image_fp, counter: Counter = None, print_path_relative_to=None, backend='cli',
+                     stats: dict = None, max_size_cap: int = None, search='proxy'):
     if print_path_relative_to:
         image_fp_rel = fstk.make_path(image_fp, relative_to=print_path_relative_to)
         if image_fp_rel == '.':
             image_fp_rel = image_fp
     else:
         image_fp_rel = image_fp
-    webp_fp = image_fp + '.webp'
     mime_type, mime_sub = (filetype.guess_mime(image_fp) or '/').split('/')
+    stats = {} if stats is None else stats
     if mime_type != 'image':
         print(f'# skip non-image {image_fp_rel}')
+        stats['skip'] = 'non-image'
         return
     if mime_sub in {'webp', 'gif'}:
         print(f'# skip {mime_sub} image {image_fp_rel}')
+        stats['skip'] = mime_sub
+        return
+    with open(image_fp, 'rb') as fd:
+        image_file_bytes = fd.read()
+    stats['hash'] = fingerprint.content_hash_buffer(image_file_bytes)
+    webp_bytes = convert_bytes_adaptive(image_file_bytes, image_fp_rel, counter=counter, backend=backend,
+                                        stats=stats, max_size_cap=max_size_cap, search=search)
+    if webp_bytes:
+        with open(image_fp + '.webp', 'wb') as f:
+            f.write(webp_bytes)
+
+
+def convert_bytes_adaptive(image_file_bytes: bytes, image_name: str, counter: Counter = None, backend='cli',
+                           stats: dict = None, max_size_cap: int = None, search='proxy'):
+    """return webp bytes of an image file content, or None if skipped
+
+    `stats` (if given) gets encode counts, and q, scale, size of the result or the reason to skip
+    `search`: 'proxy' to model (q, scale) on a downscaled proxy, 'full' for the old search by full-size encodes"""
+    stats = {} if stats is None else stats
+    mime_type, mime_sub = (filetype.guess_mime(image_file_bytes) or '/').split('/')
+    if mime_type != 'image':
+        print(f'# skip non-image {image_name}')
+        stats['skip'] = 'non-image'
+        return
+    if mime_sub in {'webp', 'gif'}:
+        print(f'# skip {mime_sub} image {image_name}')
+        stats['skip'] = mime_sub
         return
     if counter:
         counter.n += 1
-    img: PIL.Image.Image = PIL.Image.open(image_fp)
+    img: PIL.Image.Image = PIL.Image.open(io.BytesIO(image_file_bytes))
     w, h = img.size
     pixels = w * h
     if pixels > PIXELS_BASELINE * 4:
@@ -65,41 +170,50 @@ def convert_adaptive(image_fp, counter: Counter = None, print_path_relative_to=N
     else:
         max_size = 1024 * 256
         min_scale = 1
+    if max_size_cap:
+        max_size = min(max_size, max_size_cap)
     print(f'+ ({w}x{h}, q={MAX_Q}..{MIN_Q}, min_scale={min_scale}, '
-          f'max_size={max_size}, max_compress={MAX_COMPRESS}) {image_fp_rel}')
+          f'max_size={max_size}, max_compress={MAX_COMPRESS}) {image_name}')
     try:
-        with open(image_fp, 'rb') as fd:
-            image_file_bytes = fd.read()
-        cvt_gen = cwebp.cwebp_adaptive_gen___alpha(image_file_bytes, max_size=max_size, max_compress=MAX_COMPRESS,
-                                                   max_q=MAX_Q, min_q=MIN_Q, min_scale=min_scale)
+        adaptive_gen = cwebp.cwebp_adaptive_gen___alpha if search == 'full' else \
+            cwebp.cwebp_adaptive_gen_proxy___alpha
+        cvt_gen = adaptive_gen(image_file_bytes, max_size=max_size, max_compress=MAX_COMPRESS, max_q=MAX_Q,
+                               min_q=MIN_Q, min_scale=min_scale, stats=stats, backend=backend)
         for result in cvt_gen:
             d_dst = result['dst']
             print(f"* ({d_dst['width']}x{d_dst['height']}, q={d_dst.get('q', '?')}, scale={d_dst.get('scale', 1)}, "
-                  f"psnr={d_dst['psnr']['all']}, size={d_dst['size']}, compress={d_dst['compress']}) <- {image_fp_rel}")
-        with open(webp_fp, 'wb') as f:
-            f.write(result['out'])
+                  f"psnr={d_dst['psnr']['all']}, size={d_dst['size']}, compress={d_dst['compress']}) <- {image_name}")
+        print(f"# ({stats['encodes']} encodes, {stats.get('proxy_encodes', 0)} proxy encodes) {image_name}")
+        stats.update(q=d_dst.get('q'), scale=d_dst.get('scale', 1), size=d_dst['size'])
+        return result['out']
     except cwebp.SkipOverException as e:
-        print(f'# ({e.msg}) {image_fp_rel}')
+        print(f'# ({e.msg}) {image_name}')
+        stats['skip'] = e.msg
     except KeyError as e:
         print(traceback.format_exc())
-        print(f'! {image_fp_rel}')
+        print(f'! {image_name}')
         if e.args[0] == 'dst':
             pprint(result)
-        os_exit_force(1)
+        raise ConversionError(image_name, f'KeyError: {e}')
     except cwebp.CWebpEncodeError as e:
         if e.reason == e.E.BAD_DIMENSION:
-            print(f'! ({e.reason}) <- {image_fp_rel}')
+            print(f'! ({e.reason}) <- {image_name}')
+            stats['error'] = str(e.reason)
         else:
             print(traceback.format_exc())
-            print(f'! {image_fp_rel}')
-            os_exit_force(1)
+            print(f'! {image_name}')
+            raise ConversionError(image_name, e.reason)
     except cwebp.CWebpInputReadError as e:
         print(traceback.format_exc())
-        print(f'! {image_fp_rel}')
-    except Exception:
+        print(f'! {image_name}')
+        stats['error'] = type(e).__name__
+    except Exception as e:
         print(traceback.format_exc())
-        print(f'! {image_fp_rel}')
-        os_exit_force(1)
+        print(f'! {image_name}')
+        raise ConversionError(image_name, f'{type(e).__name__}: {e}')
+    finally:
+        if counter:
+            counter.encodes += stats.get('encodes', 0)
 
 
 @apr.sub(apr.rnu(), aliases=['cvt.in.zip', 'cvt.zip'])
@@ -109,10 +223,12 @@ def convert_adaptive(image_fp, counter: Counter = None, print_path_relative_to=N
 @apr.true(an.T, an.strict)
 @apr.true(an.v, an.verbose)
 @apr.opt('k', 'workers', type=int, metavar='N')
+@apr.true('S', 'stream', help='convert from zip to zip in memory, without extracting to workdir')
+@apr.opt('E', 'backend', choices=tuple(cwebp.BACKENDS), default='cli', help='encode by cwebp CLI or in-process')
 @apr.map(an.src, workdir=an.workdir, workers='workers', ext_name=an.extension,
-         strict_mode=an.strict, verbose=an.verbose)
+         strict_mode=an.strict, verbose=an.verbose, stream='stream', backend='backend')
 def convert_in_zip(src, workdir='.', workers=None, ext_name=None, strict_mode=False, verbose=False,
-                   fallback_filename_encoding=get_os_default_encoding()):
+                   fallback_filename_encoding=get_os_default_encoding(), stream=False, backend='cli'):
     """convert non-webp picture inside zip file"""
     flag_filename_of_webp_converted = '__ALREADY_WEBP_CONVERTED__'
     lgr = logging.get_logger(convert_in_zip.__name__, 'INFO' if verbose else 'ERROR', fmt=logging.LOG_FMT_MESSAGE_ONLY)
@@ -181,17 +297,37 @@ def convert_in_zip(src, workdir='.', workers=None, ext_name=None, strict_mode=Fa
 
             if not need_to_convert:
                 continue
-            unzip_dir = path_join(workdir, split_path_dir_base_ext(fp)[1])
-            try:
-                zf.extractall(unzip_dir)
-            except zipfile.BadZipFile:
-                if path_is_dir(unzip_dir):
-                    shutil.rmtree(unzip_dir)
-                continue
+            old_size = path_get_size(fp)
+            if stream:
+                try:
+                    new_zip = convert_zip_to_zip(zf, fp + '.converting', flag_filename_of_webp_converted,
+                                                 workers=workers, backend=backend)
+                except zipfile.BadZipFile:
+                    continue
+                except KeyboardInterrupt:
+                    sys.exit(2)
+            else:
+                unzip_dir = path_join(workdir, split_path_dir_base_ext(fp)[1])
+                try:
+                    zf.extractall(unzip_dir)
+                except zipfile.BadZipFile:
+                    if path_is_dir(unzip_dir):
+                        shutil.rmtree(unzip_dir)
+                    continue
 
+        if stream:
+            if ext_name:
+                fp = fstk.rename_file_ext(fp, ext_name)
+            new_size = path_get_size(new_zip)
+            fstk.move_as(new_zip, fp)
+            lgr.info(fp)
+            lgr.info(f'{new_size / old_size:.1%} ({naturalsize(new_size, True)} / {naturalsize(old_size, True)})')
+            continue
         try:
-            old_size = path_get_size(fp)
-            auto_cvt(unzip_dir, recursive=True, clean=True, cbz=False, workers=workers, verbose=verbose)
+            if auto_cvt(unzip_dir, recursive=True, clean=True, cbz=False, workers=workers, verbose=verbose,
+                        backend=backend):
+                lgr.error(f'! keep {fp} as is')
+                continue
             fstk.touch(path_join(unzip_dir, flag_filename_of_webp_converted))
             new_zip = shutil.make_archive(unzip_dir, 'zip', unzip_dir, verbose=verbose)
             if ext_name:
@@ -207,16 +343,73 @@ def convert_in_zip(src, workdir='.', workers=None, ext_name=None, strict_mode=Fa
             shutil.rmtree(unzip_dir)
 
 
+def convert_zip_to_zip(zf: zipfile.ZipFile, dst, flag_filename, workers=None, backend='cli'):
+    """read members of `zf`, convert images in a thread pool, write results in order into a new zip file `dst`
+
+    at most 2 * `workers` members are held in memory at the same time, webp members are stored without compression"""
+    workers = workers or os.cpu_count() - 1 or os.cpu_count()
+    pending = collections.deque()
+
+    def write_first_pending(new_zf: zipfile.ZipFile):
+        info, data, future = pending.popleft()
+        webp_bytes = future.result()
+        if webp_bytes:
+            new_zf.writestr(zipfile.ZipInfo(info.filename + '.webp', date_time=info.date_time), webp_bytes,
+                            compress_type=zipfile.ZIP_STORED)
+        else:
+            new_zf.writestr(zipfile.ZipInfo(info.filename, date_time=info.date_time), data,
+                            compress_type=info.compress_type)
+
+    try:
+        with zipfile.ZipFile(dst, 'w', zipfile.ZIP_DEFLATED) as new_zf, ThreadPoolExecutor(workers) as executor:
+            for i in zf.infolist():
+                if i.is_dir():
+                    new_zf.writestr(zipfile.ZipInfo(i.filename, date_time=i.date_time), b'')
+                    continue
+                if i.filename.lower().endswith('.thumb'):
+                    continue
+                data = zf.read(i)
+                pending.append((i, data, executor.submit(convert_bytes_adaptive, data, i.filename, backend=backend)))
+                while len(pending) > workers * 2:
+                    write_first_pending(new_zf)
+            while pending:
+                write_first_pending(new_zf)
+            new_zf.writestr(flag_filename, b'')
+    except BaseException:
+        if path_is_file(dst):
+            os.remove(dst)
+        raise
+    return dst
+
+
+def convert_adaptive_in_process(image_fp, print_path_relative_to=None, backend='cli', max_size_cap=None,
+                                search='proxy'):
+    """`convert_adaptive` for process pool, return (number of images, number of encodes, stats)"""
+    counter = Counter()
+    stats = {}
+    convert_adaptive(image_fp, counter=counter, print_path_relative_to=print_path_relative_to, backend=backend,
+                     stats=stats, max_size_cap=max_size_cap, search=search)
+    return counter.n, counter.encodes, stats
+
+
 @apr.sub(apr.rename_underscore())
 @apr.true('r', 'recursive')
 @apr.true('c', 'clean')
 @apr.true('z', 'cbz')
 @apr.opt('k', 'workers', type=int, metavar='N')
 @apr.true(an.B, apr.dst2opt(an.trash_bin), help='delete to trash bin')
+@apr.opt('E', 'backend', choices=tuple(cwebp.BACKENDS), default='cli', help='encode by cwebp CLI or in-process')
+@apr.true('M', 'manifest', help=f'record results in {MANIFEST_FILENAME} under each src, skip unchanged files')
+@apr.opt(long_name='retune', type=int, metavar='SIZE', help='with -M, re-convert images whose result > SIZE bytes')
+@apr.opt(long_name='search', choices=('proxy', 'full'), default='proxy',
+         help='find (q, scale) on a downscaled proxy, or by full-size encodes as before (to compare CPU time)')
 @apr.arg('src', nargs='*')
-@apr.map('src', recursive='recursive', clean='clean', cbz='cbz', workers='workers', trash_bin=an.trash_bin)
-def auto_cvt(src, recursive, clean, cbz, workers=None, trash_bin=False, verbose=False):
-    """convert images to webp with auto-clean, auto-compress-to-cbz, adaptive-quality-scale"""
+@apr.map('src', recursive='recursive', clean='clean', cbz='cbz', workers='workers', trash_bin=an.trash_bin,
+         backend='backend', manifest='manifest', retune_size='retune', search='search')
+def auto_cvt(src, recursive, clean, cbz, workers=None, trash_bin=False, verbose=False, backend='cli',
+             manifest=False, retune_size=None, search='proxy'):
+    """convert images to webp with auto-clean, auto-compress-to-cbz, adaptive-quality-scale,
+    return paths of images failed to convert"""
     workers = workers or os.cpu_count() - 1 or os.cpu_count()
     lgr = logging.get_logger(auto_cvt.__name__, 'INFO' if verbose else 'ERROR', fmt=logging.LOG_FMT_MESSAGE_ONLY)
     delete = send2trash if trash_bin else shutil.remove
@@ -226,57 +419,123 @@ def auto_cvt(src, recursive, clean, cbz, workers=None, trash_bin=False, verbose=
     ostk.ensure_sigint_signal()
     cnt = Counter()
     t0 = time.time()
-    lgr.info(f'# workers={workers}')
+    lgr.info(f'# workers={workers}, backend={backend}, search={search}')
+
+    def clean_and_cbz(s):
+        if clean:
+            lgr.info('# clean already converted original image files')
+            for fp in fstk.find_iter('f', s, recursive=recursive):
+                ext_lower = os.path.splitext(fp)[-1].lower()
+                fp_webp = fp + '.webp'
+                if ext_lower != '.webp' and os.path.isfile(fp_webp) and os.path.getsize(fp_webp):
+                    delete(fp)
+                    lgr.info(f'- {fp}')
+                    continue
+                if ext_lower == '.thumb':
+                    delete(fp)
+                    lgr.info(f'- {fp}')
+                    continue
+        if cbz:
+            if os.path.isdir(s):
+                lgr.info('# zip folder into cbz file')
+                dirs_with_image = []
+                for dp, sub_dirs, files in os.walk(s):
+                    for f in files:
+                        if re.match(r'.+\.(webp|jpg|jpeg|png)', f):
+                            dirs_with_image.append(dp)
+                            break
+                for dp in dirs_with_image:
+                    cbz_fp = dp + '.cbz'
+                    try:
+                        fstk.make_zipfile_from_dir(cbz_fp, dp, exclude=lambda n: n.startswith(MANIFEST_FILENAME))
+                    except NotADirectoryError:
+                        lgr.info(f'! {dp}')
+                    lgr.info(f'+ {cbz_fp} <- {dp}')
+                    try:
+                        delete(dp)
+                    except (OSError, WindowsError):
+                        sleep(1)
+                        delete(dp)
+                    lgr.info(f'- {dp}')
+
+    pending = {}
+    left = {}
+    enumerated = set()
+    manifests = {}
+    skipped = 0
+    failed = []
+
+    def collect(done_futures):
+        for future in done_futures:
+            s, fp, st = pending.pop(future)
+            try:
+                n, encodes, stats = future.result()
+            except ConversionError as e:
+                lgr.error(f'! {fp} ({e.args[-1]})')
+                failed.append(fp)
+                if s in manifests:
+                    manifests[s].put(fp, st, {'error': e.args[-1]})
+            else:
+                cnt.n += n
+                cnt.encodes += encodes
+                if s in manifests:
+                    manifests[s].put(fp, st, stats)
+            left[s] -= 1
+            if not left[s] and s in enumerated:
+                lgr.info(f'# done {s} ({cnt.n / (time.time() - t0):.2f} images/sec)')
+                finish(s)
+
+    def finish(s):
+        """close the manifest of `s` before cleaning & zipping, so it can be left out and the folder deleted"""
+        if s in manifests:
+            manifests.pop(s).close()
+        clean_and_cbz(s)
+
     try:
-        for s in src:
-            lgr.info(f'@ {s}')
-            with ThreadPoolExecutor(max_workers=workers) as executor:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for s in src:
+                lgr.info(f'@ {s}')
+                left[s] = 0
+                if manifest:
+                    manifests[s] = ConversionManifest(s if path_is_dir(s) else path_dirname(s) or '.')
                 for fp in fstk.find_iter('f', s, recursive=recursive):
-                    executor.submit(convert_adaptive, fp, counter=cnt, print_path_relative_to=s)
-            if clean:
-                lgr.info('# clean already converted original image files')
-                for fp in fstk.find_iter('f', s, recursive=recursive):
-                    ext_lower = os.path.splitext(fp)[-1].lower()
-                    fp_webp = fp + '.webp'
-                    if ext_lower != '.webp' and os.path.isfile(fp_webp) and os.path.getsize(fp_webp):
-                        delete(fp)
-                        lgr.info(f'- {fp}')
-                        continue
-                    if ext_lower == '.thumb':
-                        delete(fp)
-                        lgr.info(f'- {fp}')
+                    if path_basename(fp).startswith(MANIFEST_FILENAME):
                         continue
-            if cbz:
-                if os.path.isdir(s):
-                    lgr.info('# zip folder into cbz file')
-                    dirs_with_image = []
-                    for dp, sub_dirs, files in os.walk(s):
-                        for f in files:
-                            if re.match(r'.+\.(webp|jpg|jpeg|png)', f):
-                                dirs_with_image.append(dp)
-                                break
-                    for dp in dirs_with_image:
-                        cbz_fp = dp + '.cbz'
-                        try:
-                            fstk.make_zipfile_from_dir(cbz_fp, dp)
-                        except NotADirectoryError:
-                            lgr.info(f'! {dp}')
-                        lgr.info(f'+ {cbz_fp} <- {dp}')
-                        try:
-                            delete(dp)
-                        except (OSError, WindowsError):
-                            sleep(1)
-                            delete(dp)
-                        lgr.info(f'- {dp}')
+                    st = os.stat(fp)
+                    max_size_cap = None
+                    if s in manifests:
+                        todo = manifests[s].needs_convert(fp, st, retune_size)
+                        if not todo:
+                            skipped += 1
+                            continue
+                        if todo is not True:
+                            max_size_cap = todo
+                    while len(pending) >= workers * 4:
+                        collect(concurrent.futures.wait(pending, return_when=FIRST_COMPLETED).done)
+                    pending[executor.submit(convert_adaptive_in_process, fp, s, backend, max_size_cap, search)] = s, fp, st
+                    left[s] += 1
+                enumerated.add(s)
+                if not left[s]:
+                    finish(s)
+            while pending:
+                collect(concurrent.futures.wait(pending, return_when=FIRST_COMPLETED).done)
     finally:
+        for m in manifests.values():
+            m.close()
         t = time.time() - t0
         n = cnt.n
         if verbose:
             cpr.ll()
+        if skipped:
+            lgr.info(f'{skipped} files unchanged since last run (by manifest)')
+        if failed:
+            lgr.error(f'{len(failed)} images failed to convert')
         if n:
-            lgr.info(f'{n} images in {naturaldelta(t)}, {naturaldelta(t / n)} per image')
+            lgr.info(f'{n} images in {naturaldelta(t)}, {n / t:.2f} images/sec, '
+                     f'{cnt.encodes} encodes ({cnt.encodes / n:.2f} per image)')
         else:
             lgr.info(f'# no image file converted')
+    return failed
 
 
 def main():
@@ -305,19 +305,21 @@ class GetCloudflareIP(HasParser):
 
 
 def video_guess_crf_func():
-    from mylib.ffmpeg_alpha import guess_video_crf, file_is_video
+    from mylib.ffmpeg_alpha import guess_video_crf, file_is_video, CRFEstimateError
     args = rtd.args
     path_l = [path for path in list_files(args.src or clipboard) if file_is_video(path)]
     codec = args.codec
     work_dir = args.work_dir
     redo = args.redo
     auto_clean = not args.no_clean
+    full_encode = args.full
     for path in path_l:
         tui_lp.l()
         tui_lp.p(path)
         try:
-            tui_lp.p(guess_video_crf(src=path, codec=codec, work_dir=work_dir, redo=redo, auto_clean=auto_clean))
-        except (KeyError, ZeroDivisionError) as e:
+            tui_lp.p(guess_video_crf(src=path, codec=codec, work_dir=work_dir, redo=redo, auto_clean=auto_clean,
+                                     full_encode=full_encode))
+        except (KeyError, ZeroDivisionError, CRFEstimateError) as e:
             tui_lp.p(f'! {repr(e)}')
             tui_lp.p(f'- {path}')
 
@@ -328,6 +330,8 @@ video_guess_crf.add_argument('src', nargs='*')
 video_guess_crf.add_argument('-c', '--codec', nargs='?')
 video_guess_crf.add_argument('-w', '--work-dir')
 video_guess_crf.add_argument('-R', '--redo', action='store_true')
+video_guess_crf.add_argument('-F', '--full', action='store_true',
+                             help='split and encode whole segments, instead of short samples')
 video_guess_crf.add_argument('-L', '--no-clean', action='store_true')
 
 
@@ -513,8 +517,16 @@ def ffmpeg_func():
     verbose = args.verbose
     dry_run = args.dry_run
     opts = args.opts
+    jobs = args.jobs
     if verbose:
         print(args)
+    if jobs > 1:
+        from mylib.ffmpeg_alpha import kw_video_convert_batch
+        kw_video_convert_batch(mylib.__deprecated__.list_files(source, recursive=False), keywords=keywords,
+                               jobs=jobs, vf=video_filters, cut_points=cut_points, dest=output_path,
+                               overwrite=overwrite, redo=redo_origin, verbose=verbose, dry_run=dry_run,
+                               ffmpeg_opts=opts)
+        return
     for filepath in mylib.__deprecated__.list_files(source, recursive=False):
         kw_video_convert(filepath, keywords=keywords, vf=video_filters, cut_points=cut_points, dest=output_path,
                          overwrite=overwrite, redo=redo_origin, verbose=verbose, dry_run=dry_run, ffmpeg_opts=opts)
@@ -531,6 +543,7 @@ ffmpeg.add_argument('-O', '--overwrite', action='store_true')
 ffmpeg.add_argument('-R', '--redo-origin', action='store_true')
 ffmpeg.add_argument('-v', '--verbose', action='count', default=0)
 ffmpeg.add_argument('-D', '--dry-run', action='store_true')
+ffmpeg.add_argument('-j', '--jobs', type=int, default=1, help='convert files by N ffmpeg processes at the same time')
 ffmpeg.add_argument('opts', nargs='*', help='ffmpeg options (insert -- before opts)')
 
 
@@ -914,6 +927,8 @@ def view_similar_images():
         'hashsize': args.hashsize,
         'trans': args.transpose,
         'dryrun': args.dry_run,
+        'workers': args.workers,
+        'fast': args.fast,
     }
     dir_l = (p for p in (args.dir or mylib.ex.ostk.clipboard.list_path()) if os.path.isdir(p))
     if dir_l:
@@ -940,20 +955,27 @@ img_sim_view.add_argument(
     help='do not find similar images for transposed variants (rotated, flipped)')
 img_sim_view.add_argument(
     '-D', '--dry-run', action='store_true', help='find similar images, but without viewing them')
+img_sim_view.add_argument(
+    '-j', '--workers', type=int, metavar='N', help='number of processes to hash images (default: CPU count)')
+img_sim_view.add_argument(
+    '-E', '--exact-hash', action='store_false', dest='fast',
+    help='hash by imagehash itself (slow), as old imagehash.json did, instead of the fast numpy path')
 
 
 def move_ehviewer_images():
     from mylib.sites.ehentai import ehviewer_images_catalog
     args = rtd.args
     ehviewer_images_catalog(args.src or mylib.ex.ostk.clipboard.list_path()[0],
-                            dry_run=args.dry_run, db_json_path=args.db_json or 'ehdb.json')
+                            dry_run=args.dry_run, db_path=args.db or 'ehdb.sqlite',
+                            db_json_path=args.db_json or 'ehdb.json')
 
 
 ehv_img_mv = add_sub_parser('ehv.img.mv', ['ehvmv'],
                             'move ehviewer downloaded images into folders')
 ehv_img_mv.set_defaults(target=move_ehviewer_images)
 ehv_img_mv.add_argument('-D', '--dry-run', action='store_true')
-ehv_img_mv.add_argument('-j', '--db-json')
+ehv_img_mv.add_argument('-j', '--db-json', help='old JSON DB file to migrate from')
+ehv_img_mv.add_argument('-d', '--db', help='gallery metadata DB file (SQLite)')
 ehv_img_mv.add_argument('-s', '--src', nargs='?')
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""cheap content fingerprints: hash of size & a few sampled chunks (head, middle, tail) instead of whole file"""
+import contextlib
+import hashlib
+import mmap
+import os
+import sqlite3
+import typing as T
+
+from .io import SubscriptableFileIO
+
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+FINGERPRINT_SAMPLES = 3
+FINGERPRINT_ALGORITHMS = ('blake2b', 'xxh3', 'xxh64')
+
+
+def new_hasher(algorithm: str = 'blake2b'):
+    """blake2b from hashlib, or xxhash (optional dependency, faster)"""
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=16)
+    if algorithm in ('xxh3', 'xxh64'):
+        import xxhash
+        return xxhash.xxh3_128() if algorithm == 'xxh3' else xxhash.xxh64()
+    raise ValueError('unknown fingerprint algorithm', algorithm, FINGERPRINT_ALGORITHMS)
+
+
+def sample_ranges(size: int, sample_size: int = FINGERPRINT_SAMPLE_SIZE, samples: int = FINGERPRINT_SAMPLES):
+    """[(start, stop), ...] evenly spaced from head to tail, or the whole range if it is small enough"""
+    if size <= sample_size * samples:
+        return [(0, size)]
+    if samples < 2:
+        return [(0, sample_size)]
+    return [((size - sample_size) * i // (samples - 1), (size - sample_size) * i // (samples - 1) + sample_size)
+            for i in range(samples)]
+
+
+def fingerprint_buffer(buffer, sample_size: int = FINGERPRINT_SAMPLE_SIZE, samples: int = FINGERPRINT_SAMPLES,
+                       algorithm: str = 'blake2b') -> str:
+    """fingerprint of anything sliceable with a length: bytes, mmap, SubscriptableFileIO"""
+    size = len(buffer)
+    h = new_hasher(algorithm)
+    h.update(size.to_bytes(8, 'little'))
+    for start, stop in sample_ranges(size, sample_size, samples):
+        h.update(buffer[start:stop])
+    return f'{algorithm}:{h.hexdigest()}'
+
+
+@contextlib.contextmanager
+def mmap_file(path: str):
+    """read-only mmap of a file, b'' for empty file, or SubscriptableFileIO where mmap is not possible"""
+    with open(path, 'rb') as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            m = None
+        except OSError:
+            with SubscriptableFileIO(path) as sf:
+                yield sf
+            return
+        if m is None:
+            yield b''
+            return
+        with m:
+            yield m
+
+
+def file_fingerprint(path: str, sample_size: int = FINGERPRINT_SAMPLE_SIZE, samples: int = FINGERPRINT_SAMPLES,
+                     algorithm: str = 'blake2b') -> str:
+    """same as `fingerprint_buffer` of the whole file content, without reading the whole file"""
+    with mmap_file(path) as m:
+        return fingerprint_buffer(m, sample_size=sample_size, samples=samples, algorithm=algorithm)
+
+
+def content_hash_buffer(buffer, algorithm: str = 'blake2b') -> str:
+    """hash of the whole content, where a match must mean same content (e.g. to skip or reuse by it),
+    which a sampled fingerprint could not tell apart from a same-size edit outside the samples"""
+    h = new_hasher(algorithm)
+    h.update(buffer if isinstance(buffer, (bytes, bytearray, memoryview, mmap.mmap)) else buffer[0:len(buffer)])
+    return f'{algorithm}-full:{h.hexdigest()}'
+
+
+def file_content_hash(path: str, algorithm: str = 'blake2b') -> str:
+    """same as `content_hash_buffer` of the whole file content"""
+    with mmap_file(path) as m:
+        return content_hash_buffer(m, algorithm=algorithm)
+
+
+def fingerprint_digest(fingerprint: str) -> str:
+    """hex digest part of a fingerprint string"""
+    return fingerprint.rpartition(':')[-1]
+
+
+class FingerprintIndex:
+    """fingerprint -> paths of things made from that content (e.g. work folders), in a SQLite file,
+    so the things could be found again after the source file got renamed or moved"""
+
+    def __init__(self, path: str):
+        self.path = path
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute('create table if not exists fingerprint_index ('
+                                'fingerprint text, kind text, path text, primary key (fingerprint, kind, path))')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def get(self, fingerprint: str, kind: str) -> T.List[str]:
+        cursor = self.connection.execute('select path from fingerprint_index where fingerprint=? and kind=?',
+                                         (fingerprint, kind))
+        return [path for path, in cursor]
+
+    def put(self, fingerprint: str, kind: str, path: str):
+        self.connection.execute('insert or replace into fingerprint_index (fingerprint, kind, path) values (?, ?, ?)',
+                                (fingerprint, kind, path))
+        self.connection.commit()
+
+    def remove(self, fingerprint: str, kind: str, path: str = None):
+        if path is None:
+            self.connection.execute('delete from fingerprint_index where fingerprint=? and kind=?', (fingerprint, kind))
+        else:
+            self.connection.execute('delete from fingerprint_index where fingerprint=? and kind=? and path=?',
+                                    (fingerprint, kind, path))
+        self.connection.commit()
@@ -302,12 +302,16 @@ def path_parts(path):
     return pp.parts
 
 
-def make_zipfile_from_dir(zip_path, src_dir, *, strip_src_dir=True, **zipfile_kwargs):
+def make_zipfile_from_dir(zip_path, src_dir, *, strip_src_dir=True, exclude: T.Callable[[str], bool] = None,
+                          **zipfile_kwargs):
+    """`exclude`: leave out files whose name (basename) it returns True for"""
     src_dir_path = pathlib.Path(src_dir)
     if not os.path.isdir(src_dir_path):
         raise NotADirectoryError(src_dir)
     with zipfile.ZipFile(zip_path, 'w', **zipfile_kwargs) as zf:
         for file in src_dir_path.rglob('*'):
+            if exclude and exclude(file.name):
+                continue
             zf.write(file, file.relative_to(src_dir_path if strip_src_dir else src_dir_path.parent))
 
 
@@ -439,6 +443,41 @@ def move_as(src, dst, *, on_exist: OnExist = OnExist.OVERWRITE, dry_run=False, p
     raise RuntimeError('unknown situation')
 
 
+def move_by_plan(plan: T.Iterable[T.Tuple[str, str]], *, dry_run=False, callback=None) -> dict:
+    """move (src, dst) pairs grouped by the folder of dst, so each folder is made only once,
+    by `os.rename` when src is on the same device as the folder and dst does not exist, otherwise by `move_as`
+
+    `callback(src, dst, error)` is called after each pair, `error` is None if it went well
+    return counts of folders, renamed, moved & failed"""
+    groups = {}
+    for src, dst in plan:
+        groups.setdefault(os.path.dirname(dst), []).append((src, dst))
+    counts = dict.fromkeys(('folders', 'renamed', 'moved', 'failed'), 0)
+    for folder, pairs in groups.items():
+        counts['folders'] += 1
+        if not dry_run:
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            folder_dev = os.stat(folder or '.').st_dev
+        for src, dst in pairs:
+            error = None
+            try:
+                if dry_run:
+                    pass
+                elif os.stat(src).st_dev == folder_dev and not os.path.lexists(dst):
+                    os.rename(src, dst)
+                    counts['renamed'] += 1
+                else:
+                    move_as(src, dst)
+                    counts['moved'] += 1
+            except (OSError, FileSystemError) as e:
+                error = e
+                counts['failed'] += 1
+            if callback:
+                callback(src, dst, error)
+    return counts
+
+
 def regex_rename_basename(src_path, pattern, replace, *, ignore_ext=False, on_exist=OnExist.ERROR, dry_run=False):
     dirname, basename = os.path.split(src_path)
     to_rename, ext = (basename, '') if ignore_ext else os.path.splitext(basename)
@@ -10,17 +10,28 @@ assert USELESS_PLACEHOLDER_FOR_MODULE_TRICKS_LITE
 
 
 class AttributeInflection:
+    """snake_case attribute access to camelCase keys in `__dict__`, e.g. `obj.original_url` -> `obj.originalUrl`,
+    the name -> alias table is built once per class, so a lookup is a couple of dict hits instead of inflection calls"""
+    __inflection_aliases__ = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.__inflection_aliases__ = {}
+
     def __getattribute__(self, item):
+        d = object.__getattribute__(self, '__dict__')
         if item == '__dict__':
-            return object.__getattribute__(self, item)
-        item_camel = inflection.camelize(item, False)
-        underscore = inflection.underscore
-        if item in self.__dict__:
-            return self.__dict__[item]
-        elif item_camel in self.__dict__ or item in [underscore(k) for k in self.__dict__]:
-            return self.__dict__[item_camel]
-        else:
-            return object.__getattribute__(self, item)
+            return d
+        if item in d:
+            return d[item]
+        aliases = type(self).__inflection_aliases__
+        try:
+            alias = aliases[item]
+        except KeyError:
+            alias = aliases[item] = inflection.camelize(item, False)
+        if alias in d:
+            return d[alias]
+        return object.__getattribute__(self, item)
 
 
 def module_sqlitedict_with_dill(*, dill_detect_trace=False):
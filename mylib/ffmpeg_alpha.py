@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
 # encoding=utf8
+import collections
+import json
 import mimetypes
 import random
+import socket
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from math import log
 
 import ffmpeg
 import filetype
+import psutil
 
 import mylib.easy
 import mylib.easy.io
+from mylib.easy import fingerprint
 from mylib.__deprecated__ import fs_find_iter
 from mylib.easy import *
 from mylib.easy.filename_tags import EnclosedFilenameTagsSet
@@ -53,8 +59,9 @@ CODEC_TAGS_SET = set(CODEC_TAGS_DICT.values())
 decorator_choose_map_preset = mylib.easy.deco_factory_param_value_choices({'map_preset': STREAM_MAP_PRESET_TABLE.keys()})
 
 
-def file_is_video(filepath):
-    guess = filetype.guess(filepath)
+def file_is_video(filepath, head: bytes = None):
+    """`head` (first few KiB of the file, if already read) saves `filetype` from opening the file again"""
+    guess = filetype.guess(filepath if head is None else head)
     # ext = os.path.splitext(filepath)[-1]
     if guess and 'video' in guess.mime:
         return True
@@ -74,9 +81,54 @@ def filext_from_codec_name(x) -> str:
         raise TypeError(x)
 
 
+class ProbeCache:
+    """`ffmpeg.probe` results keyed by absolute path, size, mtime and probe options,
+    so probing an unchanged file again costs no ffprobe process"""
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.data = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(filepath: str, **kwargs):
+        filepath = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        return filepath, st.st_size, st.st_mtime_ns, tuple(sorted(kwargs.items()))
+
+    def probe(self, filepath: str, **kwargs) -> dict:
+        key = self.make_key(filepath, **kwargs)
+        with self.lock:
+            if key in self.data:
+                return self.data[key]
+        data = ffmpeg.probe(key[0], **kwargs)
+        with self.lock:
+            if len(self.data) >= self.max_entries:
+                del self.data[next(iter(self.data))]
+            self.data[key] = data
+        return data
+
+    def probe_many(self, filepaths: typing.Iterable[str], workers: int = None, **kwargs) -> typing.Dict[str, dict]:
+        """probe files concurrently, return {filepath: data}"""
+        filepaths = list(filepaths)
+        abs_paths = [os.path.abspath(f) for f in filepaths]  # cwd may change in other threads
+        with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 4)) as executor:
+            results = executor.map(lambda f: self.probe(f, **kwargs), abs_paths)
+            return dict(zip(filepaths, results))
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+probe_cache = ProbeCache()
+probe = probe_cache.probe
+probe_many = probe_cache.probe_many
+
+
 def excerpt_single_video_stream(filepath: str) -> dict:
     d = {}
-    data = ffmpeg.probe(filepath)
+    data = probe(filepath)
     file_format = data['format']
     streams = data['streams']
     if len(streams) == 1:
@@ -98,7 +150,7 @@ def excerpt_single_video_stream(filepath: str) -> dict:
 
 
 def get_real_duration(filepath: str) -> float:
-    d = ffmpeg.probe(filepath)['format']
+    d = probe(filepath)['format']
     duration = float(d['duration'])
     start_time = float(d.get('start_time', 0))
     return duration if start_time <= 0 else duration - start_time
@@ -170,9 +222,11 @@ class FFmpegRunnerAlpha:
             return f'{self.__class__.__name__}: {self.exit_code}\n' + '\n'.join(self.stderr_content)
 
     def __init__(self, banner: bool = True, loglevel: str = None, overwrite: bool = None,
-                 capture_out_err: bool = False):
+                 capture_out_err: bool = False, progress: typing.Union[typing.Callable[[dict], None], str] = None):
+        """`progress`: a callback or a JSON-lines file path, to receive parsed `-progress` events while running"""
         self.logger = get_logger(f'{__name__}.{self.__class__.__name__}')
         self.capture_stdout_stderr = capture_out_err
+        self.progress = progress
         self.set_head(banner=banner, loglevel=loglevel, overwrite=overwrite)
 
     @property
@@ -204,9 +258,91 @@ class FFmpegRunnerAlpha:
             return
         self.add_args(map=STREAM_MAP_PRESET_TABLE[map_preset])
 
+    @staticmethod
+    def parse_progress(block: dict) -> dict:
+        """convert a block of `-progress` key=value lines into an event with numbers"""
+
+        def number(v, cls=float):
+            try:
+                return cls(v.strip().rstrip('x').replace('kbits/s', ''))
+            except (AttributeError, ValueError):
+                return None
+
+        out_time_us = number(block.get('out_time_us'), int)
+        return {'time': time.time(),
+                'frame': number(block.get('frame'), int),
+                'fps': number(block.get('fps')),
+                'out_time': out_time_us / 1000000 if out_time_us and out_time_us > 0 else 0.,
+                'speed': number(block.get('speed')),
+                'bitrate': number(block.get('bitrate')),
+                'total_size': number(block.get('total_size'), int),
+                'progress': block.get('progress')}
+
+    def proc_progress(self, cmd: list, input_bytes: bytes = None) -> bytes:
+        """run with `-progress pipe:1`, send each parsed event to `self.progress` as it comes,
+        keep only the last lines of stderr (if captured) for the error message"""
+        cmd = cmd[:1] + ['-progress', 'pipe:1', '-nostats'] + cmd[1:]
+        callback = self.progress
+        jsonl_file = None
+        if isinstance(callback, str):
+            jsonl_file = open(callback, 'a', encoding='utf8')
+
+            def callback(event):
+                jsonl_file.write(json.dumps({'output': cmd[-1], **event}) + '\n')
+                jsonl_file.flush()
+
+        stderr_tail = collections.deque(maxlen=100)
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE if input_bytes is not None else subprocess.DEVNULL,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE if self.capture_stdout_stderr else None)
+
+        def read_stderr():
+            for line in p.stderr:
+                stderr_tail.append(line)
+
+        def write_stdin():
+            try:
+                p.stdin.write(input_bytes)
+            finally:
+                p.stdin.close()
+
+        threads = []
+        if p.stderr:
+            threads.append(threading.Thread(target=read_stderr, daemon=True))
+        if p.stdin:
+            threads.append(threading.Thread(target=write_stdin, daemon=True))
+        [t.start() for t in threads]
+        try:
+            block = {}
+            for line in p.stdout:
+                k, _, v = line.decode(errors='replace').strip().partition('=')
+                block[k] = v
+                if k == 'progress':
+                    callback(self.parse_progress(block))
+                    block = {}
+            code = p.wait()
+            [t.join() for t in threads]
+        finally:
+            if p.poll() is None:  # interrupted, e.g. by KeyboardInterrupt or a failing callback
+                p.kill()
+                p.wait()
+            p.stdout.close()
+            if jsonl_file:
+                jsonl_file.close()
+        err = b''.join(stderr_tail)
+        if code:
+            raise self.FFmpegError(code, (err or b'<error not captured>').decode())
+        if err:
+            self.logger.debug(err.decode())
+        return b''
+
+    def use_progress(self, cmd: list) -> bool:
+        return bool(self.progress) and cmd[-1] not in ('-', 'pipe:', 'pipe:1')
+
     def proc_comm(self, input_bytes: bytes) -> bytes:
         cmd = self.cmd
         self.logger.info(ostk.shlex_double_quotes_join(cmd))
+        if self.use_progress(cmd):
+            return self.proc_progress(cmd, input_bytes)
         if self.capture_stdout_stderr:
             p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         else:
@@ -226,6 +362,8 @@ class FFmpegRunnerAlpha:
         if dry_run:
             # print('dry run')
             return b''
+        if self.use_progress(cmd):
+            return self.proc_progress(cmd)
         if self.capture_stdout_stderr:
             p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         else:
@@ -359,7 +497,8 @@ class FFmpegRunnerAlpha:
 
 
 def get_width_height(filepath) -> (int, int):
-    d = ffmpeg.probe(filepath, select_streams='V')['streams'][0]
+    d = [s for s in probe(filepath)['streams']
+         if s['codec_type'] == 'video' and not s.get('disposition', {}).get('attached_pic')][0]
     return d['width'], d['height']
 
 
@@ -403,9 +542,9 @@ def get_filter_str(filters):
 
 def kw_video_convert(filepath, keywords=(), vf=None, cut_points=(),
                      overwrite=False, redo=False, ffmpeg_opts=(),
-                     verbose=0, dry_run=False,
+                     verbose=0, dry_run=False, progress=None,
                      **kwargs):
-    ff = FFmpegRunnerAlpha(overwrite=True, banner=False)
+    ff = FFmpegRunnerAlpha(overwrite=True, banner=False, progress=progress)
     if verbose > 1:
         lvl = 'DEBUG'
     elif verbose > 0:
@@ -568,6 +707,7 @@ def kw_video_convert(filepath, keywords=(), vf=None, cut_points=(),
         ff.convert([filepath], output_path, ffmpeg_args, start=start, end=end, dry_run=dry_run, **kwargs)
         logger.info(f'+ {output_path}')
         shutil.move(filepath, origin_path)
+        return output_path
     except ff.FFmpegError as e:
         logger.error(f'! {output_path}\n {e}')
         os.remove(output_path)
@@ -577,6 +717,52 @@ def kw_video_convert(filepath, keywords=(), vf=None, cut_points=(),
         sys.exit(2)
 
 
+def kw_video_convert_batch(filepaths: typing.Iterable[str], keywords=(), *, jobs: int = 2, threads: int = None,
+                           probe_workers: int = None, ffmpeg_opts=(), **kwargs) -> typing.List[dict]:
+    """`kw_video_convert` many files, `jobs` ffmpeg processes at the same time, sharing `threads` (default: all cpu)
+
+    probe all files in parallel first, then start the costliest (duration * pixels) jobs first,
+    return a summary of each converted file: wall time, realtime speed factor and size ratio"""
+    logger = get_logger(f'{__name__}.smartconv', fmt=LOG_FMT_MESSAGE_ONLY)
+    filepaths = [f for f in filepaths if os.path.isfile(f) and file_is_video(f)]
+    threads = threads or os.cpu_count() or 1
+    threads_per_job = max(1, threads // jobs)
+
+    def cost(f):
+        try:
+            w, h = get_width_height(f)
+            return get_real_duration(f) * w * h
+        except (ffmpeg.Error, IndexError, KeyError, ValueError):
+            return 0
+
+    def job(f):
+        input_size = os.path.getsize(f)
+        try:
+            duration = get_real_duration(f)
+        except (ffmpeg.Error, KeyError, ValueError):
+            duration = None
+        t = time.time()
+        output_path = kw_video_convert(f, keywords=keywords, threads=threads_per_job,
+                                       ffmpeg_opts=(*ffmpeg_opts, '-loglevel', 'warning', '-nostats'), **kwargs)
+        wall = time.time() - t
+        if not output_path or not os.path.isfile(output_path):
+            return
+        return {'input': f, 'output': output_path, 'wall_time': round(wall, 3),
+                'speed': round(duration / wall, 3) if duration else None,
+                'size_ratio': round(os.path.getsize(output_path) / input_size, 3)}
+
+    t0 = time.time()
+    probe_many(filepaths, workers=probe_workers)
+    filepaths.sort(key=cost, reverse=True)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        summary = [r for r in executor.map(job, filepaths) if r]
+    for r in summary:
+        logger.info(f"{r['speed']}x, {r['size_ratio']:.1%} in {r['wall_time']}s: {r['output']}")
+    logger.info(f'{len(summary)} of {len(filepaths)} files in {time.time() - t0:.1f}s, '
+                f'{jobs} jobs x {threads_per_job} threads')
+    return summary
+
+
 def parse_kw_opt_str(kw: str):
     if kw[:3] == 'crf' and kw[3:].isdecimal():
         return FFmpegArgsList(crf=float(kw[3:]))
@@ -590,10 +776,128 @@ def parse_kw_opt_str(kw: str):
         return FFmpegArgsList(pix_fmt='yuv420p10le')
 
 
-def guess_video_crf(src, codec, *, redo=False, work_dir=None, auto_clean=True):
+def convert_segments_worker(root: str, threads: int = None, log_lvl=None, progress: str = None) -> int:
+    """encode segments of the container at `root` one by one until none left to claim, for process pool"""
+    return FFmpegSegmentsContainer(root, log_lvl=log_lvl, progress=progress).convert_claimable_segments(
+        threads=threads)
+
+
+SAMPLE_CRF_CODEC_ARGS = {'h264': ('-c:v', 'libx264'),
+                         'hevc': ('-c:v', 'libx265', '-x265-params', 'log-level=error'),
+                         'vp9': ('-c:v', 'libvpx-vp9', '-b:v', '0', '-row-mt', '1',
+                                 '-deadline', 'good', '-cpu-used', '4')}
+SAMPLE_CRF_DEFAULT = {'h264': 23, 'hevc': 28, 'vp9': 31}
+
+
+class CRFEstimateError(ValueError):
+    """the CRF could not be estimated, e.g. unsupported codec, or output bit rate not falling as CRF rises"""
+
+
+def get_video_bit_rate_in_window(filepath: str, start: float, duration: float) -> float:
+    """bit rate of the first video stream within [start, start + duration), from its packets sizes"""
+    p = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'V:0', '-read_intervals',
+                        f'{start}%+{duration}', '-show_entries', 'packet=size', '-of', 'csv=p=0', filepath],
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    size = sum(int(line.strip(b',')) for line in p.stdout.split() if line.strip(b',').isdigit())
+    return 8 * size / duration
+
+
+def encode_sample_bit_rate(filepath: str, start: float, duration: float, codec_args, crf, vf=None) -> float:
+    """encode a window of the first video stream, return the output bit rate"""
+    cmd = [FFmpegRunnerAlpha.exe, '-hide_banner', '-loglevel', 'error', '-ss', str(start), '-t', str(duration),
+           '-i', filepath, '-map', '0:V:0', '-an', *codec_args, '-crf', str(crf)]
+    if vf:
+        cmd += ['-vf', vf]
+    cmd += ['-f', 'matroska', '-']
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if p.returncode:
+        raise FFmpegRunnerAlpha.FFmpegError(p.returncode, p.stderr.decode())
+    return 8 * len(p.stdout) / duration
+
+
+def estimate_crf_by_samples(filepath: str, codec: str = None, *, samples: int = 4, sample_duration: float = 2,
+                            crf_offsets=(-6, 0, 6), res_limit=None, workers: int = None) -> dict:
+    """estimate the CRF at which the output video bit rate would equal the input's
+
+    encode short windows sampled across the video at several CRF values in parallel, fit log2(output / input
+    bit rate) against CRF by least squares, and solve it for 0
+    return {'crf', 'slope', 'r2', 'stderr', 'samples'}, `stderr` (in CRF) is the spread of per-window estimates
+    raise `CRFEstimateError` for a codec not in `SAMPLE_CRF_CODEC_ARGS`, a fitted slope about 0 or above,
+    or a CRF out of range"""
+    data = probe(filepath, select_streams='V:0')
+    stream = data['streams'][0]
+    codec = VIDEO_CODECS_A10N.get(codec, codec) or stream['codec_name']
+    codec = {'vp8': 'vp9'}.get(codec, codec)
+    if codec not in SAMPLE_CRF_CODEC_ARGS:
+        raise CRFEstimateError('unsupported codec', codec)
+    codec_args = SAMPLE_CRF_CODEC_ARGS[codec]
+    crf0 = SAMPLE_CRF_DEFAULT[codec]
+    crf_list = [crf0 + o for o in crf_offsets]
+    duration = get_real_duration(filepath)
+    sample_duration = min(sample_duration, duration)
+    samples = max(1, min(samples, int(duration // sample_duration)))
+    starts = [round((i + .5) * duration / samples - sample_duration / 2, 3) for i in range(samples)]
+    starts = [max(0., min(t, duration - sample_duration)) for t in starts]
+    vf = get_vf_res_scale_down(stream['width'], stream['height'], res_limit=res_limit) if res_limit else None
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        input_rates = list(executor.map(lambda t: get_video_bit_rate_in_window(filepath, t, sample_duration), starts))
+        jobs = {(t, crf): executor.submit(encode_sample_bit_rate, filepath, t, sample_duration, codec_args, crf, vf)
+                for t in starts for crf in crf_list}
+        output_rates = {k: f.result() for k, f in jobs.items()}
+
+    def fit(points):
+        n = len(points)
+        mx = sum(x for x, _ in points) / n
+        my = sum(y for _, y in points) / n
+        sxx = sum((x - mx) ** 2 for x, _ in points)
+        sxy = sum((x - mx) * (y - my) for x, y in points)
+        syy = sum((y - my) ** 2 for _, y in points)
+        slope = sxy / sxx
+        r2 = sxy ** 2 / (sxx * syy) if syy else 1.
+        return slope, my - slope * mx, r2
+
+    total_input = sum(input_rates)
+    if not total_input or not all(output_rates.values()):
+        raise CRFEstimateError('empty samples', filepath)
+    slope, intercept, r2 = fit([(crf, log(sum(output_rates[t, crf] for t in starts) / total_input, 2))
+                                for crf in crf_list])
+    if slope > -.02:  # about -1/6 (half bit rate per 6 CRF) is typical
+        raise CRFEstimateError('output bit rate does not fall as CRF rises', slope)
+    crf = -intercept / slope
+    if not 0 <= crf <= 63:
+        raise CRFEstimateError('CRF out of range', crf)
+    per_window = []
+    for t, input_rate in zip(starts, input_rates):
+        if input_rate and all(output_rates[t, c] for c in crf_list):
+            w_slope, w_intercept, _ = fit([(c, log(output_rates[t, c] / input_rate, 2)) for c in crf_list])
+            if w_slope < 0:
+                per_window.append(-w_intercept / w_slope)
+    if len(per_window) > 1:
+        mean = sum(per_window) / len(per_window)
+        stderr = (sum((x - mean) ** 2 for x in per_window) / (len(per_window) - 1) / len(per_window)) ** .5
+    else:
+        stderr = None
+    return {'crf': round(crf, 1), 'slope': round(slope, 4), 'r2': round(r2, 4),
+            'stderr': round(stderr, 2) if stderr is not None else None, 'samples': samples}
+
+
+def guess_video_crf(src, codec, *, redo=False, work_dir=None, auto_clean=True, full_encode=False):
+    """estimate by samples, or by encoding whole segments if `full_encode` or the samples give no usable fit,
+    raise `CRFEstimateError` if the codec is supported by neither"""
     tf = EnclosedFilenameTagsSet(src)
     if not redo and 'crf' in tf.keys:
         return float(tf.tags_dict['crf'])
+    if not full_encode:
+        try:
+            crf_guess = estimate_crf_by_samples(src, codec)['crf']
+        except CRFEstimateError as e:
+            if e.args[0] == 'unsupported codec':
+                raise
+        else:
+            tf.tag(crf=crf_guess)
+            shutil.move(src, tf.path)
+            return crf_guess
     c = FFmpegSegmentsContainer(src, work_dir=work_dir, log_lvl='WARNING')
     try:
         crf_guess = c.guess_crf(codec)
@@ -605,6 +909,61 @@ def guess_video_crf(src, codec, *, redo=False, work_dir=None, auto_clean=True):
             c.purge()
 
 
+class SegmentStateTable:
+    """in-memory state of output segments, {(stream_id, segment_file): 'lock' or 'done'},
+    kept in sync with an append-only journal file shared by all processes (and hosts) working on the container,
+    so a state check only reads the lines appended since the last check"""
+    TODO = 'todo'
+    LOCK = 'lock'
+    DONE = 'done'
+
+    def __init__(self, journal_path: str):
+        self.journal_path = journal_path
+        self.states = {}
+        self.offset = 0
+        self.inode = None
+
+    def refresh(self) -> bool:
+        """read new lines of the journal, return False if there is no journal yet"""
+        try:
+            with open(self.journal_path, 'rb') as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self.inode:  # journal replaced
+                    self.inode, self.offset, self.states = inode, 0, {}
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        end = data.rfind(b'\n') + 1  # the last line may be still being written
+        for line in data[:end].decode('utf8').splitlines():
+            state, stream_id, segment_file = line.split('\t')
+            if state == self.TODO:
+                self.states.pop((stream_id, segment_file), None)
+            else:
+                self.states[(stream_id, segment_file)] = state
+        self.offset += end
+        return True
+
+    def record(self, *entries: T.Tuple[str, str, str]):
+        """append (state, stream_id, segment_file) entries to the journal in one write"""
+        if not entries:
+            return
+        data = ''.join(f'{state}\t{stream_id}\t{segment_file}\n' for state, stream_id, segment_file in entries)
+        fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, data.encode('utf8'))
+        finally:
+            os.close(fd)
+
+    def list(self, state: str) -> list:
+        self.refresh()
+        return [k for k, v in self.states.items() if v == state]
+
+    def get(self, stream_id: str, segment_file: str) -> str:
+        self.refresh()
+        return self.states.get((stream_id, segment_file), self.TODO)
+
+
 class FFmpegSegmentsContainer:
     nickname = 'ffsegcon'
     tag_file = 'FFMPEG_SEGMENTS_CONTAINER.TAG'
@@ -614,6 +973,7 @@ class FFmpegSegmentsContainer:
     test_json = 't.json'
     metadata_file = 'metadata.txt'
     concat_list_file = 'concat.txt'
+    segment_state_journal = 's.journal'
     suffix_done = '.DONE'
     suffix_lock = '.LOCK'
     suffix_delete = '.DELETE'
@@ -629,6 +989,10 @@ class FFmpegSegmentsContainer:
     output_prefix = 'o-'
     output_json = 'o.json'
     output_data = None
+    fingerprint = None
+    _segment_states = None
+    index_kind = 'ffsegcon'
+    index_path = os.path.join(os.path.expanduser('~'), '.ffsegcon_index.sqlite')
 
     class PathError(Exception):
         pass
@@ -651,12 +1015,18 @@ class FFmpegSegmentsContainer:
     def __repr__(self):
         return "{} at '{}' from '{}'".format(FFmpegSegmentsContainer.__name__, self.root, self.input_filepath)
 
-    def __init__(self, path: str, work_dir: str = None, single_video_stream: bool = True, log_lvl=None):
+    def __init__(self, path: str, work_dir: str = None, single_video_stream: bool = True, log_lvl=None,
+                 progress=None, index_path: str = None):
+        """`index_path`: SQLite file of fingerprint -> container folders (default `index_path` of the class,
+        empty string to disable), lets a renamed or moved input file reuse its existing container"""
         self.logger = get_logger(f'{__name__}.{self.nickname}')
-        self.ff = FFmpegRunnerAlpha(banner=False, loglevel='warning', overwrite=True, capture_out_err=True)
+        self.ff = FFmpegRunnerAlpha(banner=False, loglevel='warning', overwrite=True, capture_out_err=True,
+                                    progress=progress)
         if log_lvl:
             self.logger.setLevel(log_lvl)
             self.ff.logger.setLevel(log_lvl)
+        if index_path is not None:
+            self.index_path = index_path
         _path = os.path.abspath(path)
         select_streams = 'V:0' if single_video_stream else 'V'
         if not os.path.exists(_path):
@@ -664,17 +1034,20 @@ class FFmpegSegmentsContainer:
 
         if os.path.isfile(_path):
             self.input_filepath = _path
-            if file_is_video(_path):
-                d, b = os.path.split(_path)
-                self.input_data = {S_FILENAME: b, S_SEGMENT: {}, S_NON_SEGMENT: {}}
-                with mylib.easy.io.SubscriptableFileIO(_path) as f:
-                    middle = f.size // 2
-                    root_base = '.{}-{}'.format(self.nickname, tricks.hex_hash(
-                        f[:4096] + f[middle - 2048:middle + 2048] + f[-4096:])[:8])
-                work_dir = work_dir or d
-                _path = self.root = os.path.join(work_dir, root_base)  # file path -> dir path
-            else:
-                raise self.PathError("non-video file: '{}'".format(_path))
+            with fingerprint.mmap_file(_path) as f:
+                if not file_is_video(_path, head=f[:8192]):
+                    raise self.PathError("non-video file: '{}'".format(_path))
+                self.fingerprint = fingerprint.fingerprint_buffer(f)
+                middle = len(f) // 2
+                legacy_root_base = '.{}-{}'.format(self.nickname, tricks.hex_hash(
+                    f[:4096] + f[max(middle - 2048, 0):middle + 2048] + f[-4096:])[:8])
+            d, b = os.path.split(_path)
+            self.input_data = {S_FILENAME: b, S_SEGMENT: {}, S_NON_SEGMENT: {}}
+            work_dir = work_dir or d
+            root_base = '.{}-{}'.format(self.nickname, fingerprint.fingerprint_digest(self.fingerprint)[:8])
+            _path = self.root = os.path.join(work_dir, root_base)  # file path -> dir path
+            if not os.path.isdir(_path):
+                _path = self.root = self.find_existing_root(os.path.join(work_dir, legacy_root_base)) or _path
 
         try:
             if not os.path.isdir(_path):
@@ -697,15 +1070,42 @@ class FFmpegSegmentsContainer:
                     if S_FILENAME not in self.input_data:
                         self.read_filename()
                     self.read_output_json()
+                    self.index_root()
                 except KeyError:
                     shutil.rmtree(_path)
                     self = FFmpegSegmentsContainer(path=path, work_dir=work_dir,
-                                                   single_video_stream=single_video_stream, log_lvl=log_lvl)
+                                                   single_video_stream=single_video_stream, log_lvl=log_lvl,
+                                                   progress=progress, index_path=index_path)
         except KeyboardInterrupt:
             sleep(.5)
             shutil.rmtree(_path)
             raise self.ContainerError('aborted')
 
+    def open_index(self):
+        if self.index_path and self.fingerprint:
+            return fingerprint.FingerprintIndex(self.index_path)
+
+    def find_existing_root(self, legacy_root: str = None):
+        """container folder of the same input content: in the old naming, or elsewhere by the fingerprint index"""
+        if legacy_root and os.path.isdir(legacy_root) and self.container_is_tagged(legacy_root):
+            return legacy_root
+        index = self.open_index()
+        if not index:
+            return None
+        with index:
+            for root in index.get(self.fingerprint, self.index_kind):
+                if os.path.isdir(root) and self.container_is_tagged(root):
+                    self.logger.info(f'reuse container: {root}')
+                    return root
+                index.remove(self.fingerprint, self.index_kind, root)
+        return None
+
+    def index_root(self):
+        index = self.open_index()
+        if index:
+            with index:
+                index.put(self.fingerprint, self.index_kind, os.path.abspath(self.root))
+
     def write_filename(self):
         if self.input_filepath:
             fn = os.path.split(self.input_filepath)[-1]
@@ -713,15 +1113,20 @@ class FFmpegSegmentsContainer:
             fn = self.input_data.get(S_FILENAME)
         if not fn:
             return
+        changed = self.input_data.get(S_FILENAME) != fn
         self.input_data[S_FILENAME] = fn
         with fstk.ctx_pushd(self.root):
             prefix = self.input_filename_prefix
             for f in fs_find_iter(pattern=prefix + '*', recursive=False, strip_root=True):
-                fstk.x_rename(f, prefix + fn, append_src_ext=False)
+                if f != prefix + fn:
+                    fstk.x_rename(f, prefix + fn, append_src_ext=False)
+                    changed = True
                 break
             else:
                 fstk.touch(prefix + fn)
-            fstk.write_json_file(self.input_json, self.input_data, indent=4)
+                changed = True
+            if changed:  # do not rewrite it needlessly, other processes or hosts may be reading it
+                fstk.write_json_file(self.input_json, self.input_data, indent=4)
 
     def read_filename(self):
         with fstk.ctx_pushd(self.root):
@@ -740,7 +1145,7 @@ class FFmpegSegmentsContainer:
         d = self.input_data or {S_SEGMENT: {}, S_NON_SEGMENT: {}}
 
         with fstk.ctx_pushd(self.root):
-            for stream in ffmpeg.probe(i_file, select_streams=select_streams)['streams']:
+            for stream in probe(i_file, select_streams=select_streams)['streams']:
                 index = stream['index']
                 # codec = stream['codec_name']
                 # suitable_filext = CODEC_NAME_TO_FILEXT_TABLE.get(codec)
@@ -786,13 +1191,15 @@ class FFmpegSegmentsContainer:
                 seg_folder = prefix + k
                 d[S_SEGMENT][k] = {}
                 with fstk.ctx_pushd(seg_folder):
-                    for file in fs_find_iter(pattern=self.segment_filename_regex_pattern, regex=True,
-                                             recursive=False, strip_root=True):
+                    files = list(fs_find_iter(pattern=self.segment_filename_regex_pattern, regex=True,
+                                              recursive=False, strip_root=True))
+                    probe_many(files)
+                    for file in files:
                         d[S_SEGMENT][k][file] = excerpt_single_video_stream(file)
             for k in d[S_NON_SEGMENT]:
                 file = prefix + k
                 if os.path.isfile(file):
-                    d[S_NON_SEGMENT][k] = ffmpeg.probe(file)
+                    d[S_NON_SEGMENT][k] = probe(file)
                 else:
                     del d[S_NON_SEGMENT][k]
             fstk.write_json_file(self.input_json, d, indent=4)
@@ -822,19 +1229,22 @@ class FFmpegSegmentsContainer:
             with open(self.tag_file, 'w') as f:
                 f.write(self.tag_sig)
 
-    def container_is_tagged(self) -> bool:
-        with fstk.ctx_pushd(self.root):
-            try:
-                with open(self.tag_file) as f:
-                    return f.readline().rstrip('\r\n') == self.tag_sig
-            except FileNotFoundError:
-                return False
+    def container_is_tagged(self, root: str = None) -> bool:
+        try:
+            with open(os.path.join(root or self.root, self.tag_file)) as f:
+                return f.readline().rstrip('\r\n') == self.tag_sig
+        except FileNotFoundError:
+            return False
 
     def is_split(self) -> bool:
         return bool(self.read_input_json())
 
     def purge(self):
         shutil.rmtree(self.root, ignore_errors=True)
+        index = self.open_index()
+        if index:
+            with index:
+                index.remove(self.fingerprint, self.index_kind, os.path.abspath(self.root))
         self.__dict__ = {}
 
     def config(self,
@@ -968,7 +1378,7 @@ class FFmpegSegmentsContainer:
         self.config(**conf[S_ORIGINAL])
 
     def merge(self):
-        if not self.read_output_json():
+        if not self.output_data and not self.read_output_json():
             raise self.ContainerError('no output config')
         if self.list_lock_segments() or \
                 len(self.list_done_segments()) != len(self.list_all_segments()):
@@ -996,8 +1406,8 @@ class FFmpegSegmentsContainer:
             for index in d:
                 folder = self.output_prefix + index
                 os.makedirs(folder, exist_ok=True)
-                with fstk.ctx_pushd(folder):
-                    lines = ["file '{}'".format(os.path.join(folder, seg)) for seg in
+                with fstk.ctx_pushd(folder):  # concat demuxer resolves paths relative to the list file
+                    lines = ["file '{}'".format(seg) for seg in
                              sorted(d[index].keys(), key=lambda x: int(os.path.splitext(x)[0]))]
                     with fstk.ensure_open_file(self.concat_list_file, 'w') as f:
                         f.write('\n'.join(lines))
@@ -1018,58 +1428,146 @@ class FFmpegSegmentsContainer:
         return segments
 
     def list_untouched_segments(self):
-        all_segments = self.list_all_segments()
-        lock_segments = self.list_lock_segments()
-        done_segments = self.list_done_segments()
-        return tricks.remove_from_list(tricks.remove_from_list(all_segments, lock_segments), done_segments)
+        touched = set(self.segment_states.states)
+        return [seg for seg in self.list_all_segments() if seg not in touched]
 
     def list_lock_segments(self):
-        segments = []
-        prefix = self.output_prefix
-        with fstk.ctx_pushd(self.root):
-            for index in self.input_data[S_SEGMENT]:
-                with fstk.ctx_pushd(prefix + index):
-                    segments.extend([(index, f.rstrip(self.suffix_lock)) for f in
-                                     fs_find_iter('*' + self.suffix_lock)])
-        return segments
+        return self.segment_states.list(SegmentStateTable.LOCK)
 
     def list_done_segments(self):
-        segments = []
-        prefix = self.output_prefix
-        with fstk.ctx_pushd(self.root):
-            for index in self.input_data[S_SEGMENT]:
-                with fstk.ctx_pushd(prefix + index):
-                    segments.extend([(index, f.rstrip(self.suffix_done)) for f in
-                                     fs_find_iter('*' + self.suffix_done)])
-        return segments
+        return self.segment_states.list(SegmentStateTable.DONE)
 
-    def convert(self, overwrite: bool = False):
+    @property
+    def segment_states(self) -> SegmentStateTable:
+        """state table of output segments, refreshed from the journal, checked against the files on first use"""
+        if self._segment_states is None:
+            self.sync_segment_states()
+        else:
+            self._segment_states.refresh()
+        return self._segment_states
+
+    def segment_key(self, filepath):
+        """output segment file path -> (stream_id, segment_file)"""
+        folder, segment_file = os.path.split(filepath)
+        return os.path.basename(folder)[len(self.output_prefix):], segment_file
+
+    def record_segment_state(self, state, filepath):
+        self.segment_states.record((state, *self.segment_key(filepath)))
+
+    def scan_segment_states(self) -> dict:
+        """{(stream_id, segment_file): state} from lock & done files, one directory scan per stream"""
+        states = {}
+        for index in self.input_data[S_SEGMENT]:
+            try:
+                names = [e.name for e in os.scandir(os.path.join(self.root, self.output_prefix + index))]
+            except FileNotFoundError:
+                continue
+            for name in names:
+                if name.endswith(self.suffix_done):
+                    states[(index, name[:-len(self.suffix_done)])] = SegmentStateTable.DONE
+                elif name.endswith(self.suffix_lock):
+                    states.setdefault((index, name[:-len(self.suffix_lock)]), SegmentStateTable.LOCK)
+        return states
+
+    def sync_segment_states(self):
+        """journal whatever the lock & done files say differently from the state table,
+        e.g. for containers made before the journal, or changed by hand"""
+        table = self._segment_states
+        if table is None:
+            table = self._segment_states = SegmentStateTable(os.path.join(self.root, self.segment_state_journal))
+        table.refresh()
+        known = dict(table.states)
+        on_disk = self.scan_segment_states()
+        table.record(*[(state, *key) for key, state in on_disk.items() if known.get(key) != state],
+                     *[(SegmentStateTable.TODO, *key) for key in known if key not in on_disk])
+        table.refresh()
+
+    def convert(self, overwrite: bool = False, workers: int = 1, threads: int = None, lock_timeout: float = None):
+        """encode all segments, return the number of segments encoded by this call
+
+        segments are claimed by atomically created lock files, so `workers` local processes, as well as any number of
+        hosts sharing this container folder, can run `convert` at the same time, each taking the segments left over
+        `threads` is per-segment ffmpeg threads, `lock_timeout` (seconds) breaks locks of other hosts older than it"""
+        self.sync_segment_states()
+        self.release_stale_locks(lock_timeout)
+        if workers > 1:
+            if overwrite:
+                self.clear()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                progress = self.ff.progress if isinstance(self.ff.progress, str) else None  # callback can't pickle
+                futures = [executor.submit(convert_segments_worker, self.root, threads, self.logger.level, progress)
+                           for _ in range(workers)]
+                return sum(f.result() for f in futures)
+        return self.convert_claimable_segments(overwrite=overwrite, threads=threads)
+
+    def convert_claimable_segments(self, overwrite: bool = False, threads: int = None):
         if overwrite:
-            def get_segments():
-                return self.list_all_segments()
+            segments = self.list_all_segments()
         else:
-            def get_segments():
-                return self.list_untouched_segments()
-        segments = get_segments()
-        while segments:
-            # stream_id, segment_file = random.choice(segments)
-            stream_id, segment_file = segments.pop(0)
-            self.convert_one_segment(stream_id, segment_file, overwrite=overwrite)
+            segments = self.list_untouched_segments()
+        n = 0
+        for stream_id, segment_file in segments:
+            if not overwrite and self.segment_states.get(stream_id, segment_file) != SegmentStateTable.TODO:
+                continue
+            try:
+                self.convert_one_segment(stream_id, segment_file, overwrite=overwrite, threads=threads)
+                n += 1
+            except (self.SegmentLockedError, self.SegmentDeleteRequest):
+                continue
+        return n
+
+    @staticmethod
+    def lock_owner():
+        return f'{socket.gethostname()} {os.getpid()}'
+
+    def release_stale_locks(self, lock_timeout: float = None):
+        """remove locks left by dead processes of this host, or (if `lock_timeout`) by other hosts long ago"""
+        hostname = socket.gethostname()
+        with fstk.ctx_pushd(self.root):
+            for i, seg in self.list_lock_segments():
+                o_seg = os.path.join(self.output_prefix + i, seg)
+                lock = o_seg + self.suffix_lock
+                try:
+                    with open(lock) as f:
+                        host, _, pid = f.read().strip().partition(' ')
+                    age = time.time() - os.path.getmtime(lock)
+                except (OSError, ValueError):
+                    continue
+                if host == hostname and pid.isdigit() and psutil.pid_exists(int(pid)):
+                    continue
+                if host != hostname and (not lock_timeout or age < lock_timeout):
+                    continue
+                self.logger.info(f'release stale lock {lock} of {host} {pid}')
+                if os.path.isfile(o_seg):
+                    os.remove(o_seg)
+                os.remove(lock)
+                self.record_segment_state(SegmentStateTable.TODO, o_seg)
 
     def nap(self):
         t = round(random.uniform(0.2, 0.4), 3)
         self.logger.debug('sleep {}s'.format(t))
         sleep(t)
 
-    def file_tag_lock(self, filepath):
-        if self.file_has_lock(filepath) or self.file_has_done(filepath):
-            return
-        else:
-            fstk.touch(filepath + self.suffix_lock)
+    def file_tag_lock(self, filepath) -> bool:
+        """claim the file by creating its lock file exclusively, return False if locked by others or done"""
+        if self.file_has_done(filepath):
+            return False
+        try:
+            fd = os.open(filepath + self.suffix_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.lock_owner())
+        if self.file_has_done(filepath):  # done by others just between the check and the lock
+            os.remove(filepath + self.suffix_lock)
+            return False
+        self.record_segment_state(SegmentStateTable.LOCK, filepath)
+        return True
 
     def file_tag_unlock(self, filepath):
         if self.file_has_lock(filepath):
             os.remove(filepath + self.suffix_lock)
+            self.record_segment_state(SegmentStateTable.TODO, filepath)
 
     def file_tag_done(self, filepath):
         if self.file_has_done(filepath):
@@ -1077,22 +1575,26 @@ class FFmpegSegmentsContainer:
         if self.file_has_lock(filepath):
             fstk.x_rename(filepath + self.suffix_lock, filepath + self.suffix_done,
                           stay_in_src_dir=False, append_src_ext=False)
+            self.record_segment_state(SegmentStateTable.DONE, filepath)
 
     def file_tag_delete(self, filepath):
         fstk.touch(filepath + self.suffix_delete)
 
-    def convert_one_segment(self, stream_id, segment_file, overwrite=False) -> dict:
+    def convert_one_segment(self, stream_id, segment_file, overwrite=False, threads: int = None) -> dict:
         segment_path_no_prefix = os.path.join(stream_id, segment_file)
         i_seg = self.input_prefix + segment_path_no_prefix
         o_seg = self.output_prefix + segment_path_no_prefix
         args = self.output_data[S_SEGMENT]
+        if threads:
+            args = FFmpegArgsList(*args, threads=threads)
         with fstk.ctx_pushd(self.root):
-            self.nap()
-            if self.file_has_lock(o_seg):
-                raise self.SegmentLockedError
             if not overwrite and self.file_has_done(o_seg):
                 return self.get_done_segment_info(filepath=o_seg)
-            self.file_tag_lock(o_seg)
+            if overwrite and self.file_has_done(o_seg) and not self.file_has_lock(o_seg):
+                os.remove(o_seg + self.suffix_done)
+                self.record_segment_state(SegmentStateTable.TODO, o_seg)
+            if not self.file_tag_lock(o_seg):
+                raise self.SegmentLockedError
             try:
                 saved_error = None
                 self.ff.convert([i_seg], o_seg, args)
@@ -1139,8 +1641,11 @@ class FFmpegSegmentsContainer:
             sd['min']['ratio'] = round(sd['min']['output']['bit_rate'] / sd['min']['input']['bit_rate'], 3)
             sd['max']['ratio'] = round(sd['max']['output']['bit_rate'] / sd['max']['input']['bit_rate'], 3)
 
-            k = (sd['max']['output']['bit_rate'] - sd['min']['output']['bit_rate']) / (
-                    sd['max']['input']['bit_rate'] - sd['min']['input']['bit_rate'])
+            input_span = sd['max']['input']['bit_rate'] - sd['min']['input']['bit_rate']
+            if input_span:
+                k = (sd['max']['output']['bit_rate'] - sd['min']['output']['bit_rate']) / input_span
+            else:  # one segment, or all of the same bit rate: output in proportion to input
+                k = sd['min']['output']['bit_rate'] / sd['min']['input']['bit_rate']
 
             def linear_estimate(input_bit_rate):
                 return k * (input_bit_rate - sd['min']['input']['bit_rate']) + sd['min']['output']['bit_rate']
@@ -1176,6 +1681,7 @@ class FFmpegSegmentsContainer:
                         self.logger.info('delete done segment {}'.format(o_seg))
                         os.remove(o_seg)
                         os.remove(o_seg + self.suffix_done)
+                        self.record_segment_state(SegmentStateTable.TODO, o_seg)
                     elif self.file_has_lock(o_seg):
                         self.logger.info('request delete locked segment {}'.format(o_seg))
                         fstk.touch(o_seg + self.suffix_delete)
@@ -1218,9 +1724,13 @@ class FFmpegSegmentsContainer:
         config_funcs_d = {'h264': self.config_video, 'hevc': self.config_hevc, 'vp9': self.config_vp9}
         codec = VIDEO_CODECS_A10N.get(codec, codec) or d['codec_name']
         codec = {'vp8': 'vp9'}.get(codec, codec)
+        if codec not in config_funcs_d:
+            raise CRFEstimateError('unsupported codec', codec)
         config_func = config_funcs_d[codec]
-        crf0 = {'h264': 23, 'hevc': 28, 'vp9': 31}[codec]
+        crf0 = SAMPLE_CRF_DEFAULT[codec]
         config_func(crf=crf0, res_limit=res_limit)
         e = self.estimate()
         r = e[i]
+        if not r > 0:
+            raise CRFEstimateError('empty output', r)
         return round(crf0 + 6 * log(r, 2), 1)
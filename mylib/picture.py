@@ -2,15 +2,20 @@
 # encoding=utf8
 import copy
 import json
+import math
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from itertools import combinations
 from logging import warning
 from typing import Iterable
 
+import numpy as np
 from PIL import Image
 from disjoint_set import DisjointSet
-from imagehash import average_hash, dhash, phash, whash, hex_to_hash
+from imagehash import ImageHash, average_hash, dhash, phash, whash, hex_to_hash
 
 from mylib.easy import *
+from mylib.easy.fingerprint import file_content_hash
 from mylib.ex import fstk
 from mylib.ex.ostk import check_file_ext
 from mylib.easy.tricks import percentage
@@ -31,6 +36,7 @@ IMAGE_FILE_EXT_ANIMATION = ['.gif', '.apng']
 DEFAULT_IMAGE_HASHTYPE = DHASH
 DEFAULT_IMAGE_HASHSIZE = 8
 IMAGEHASH_FILENAME = 'imagehash.json'
+IMAGEHASH_DB_FILENAME = 'imagehash.sqlite'
 SIMILAR_IMAGE_FOLDER = '__similar__'
 
 
@@ -52,20 +58,79 @@ def open_image_file(path: str) -> Image.Image:
     return Image.open(path)
 
 
+def _ahash_array(pixels: np.ndarray, hashsize: int) -> np.ndarray:
+    return pixels > pixels.mean()
+
+
+def _dhash_array(pixels: np.ndarray, hashsize: int) -> np.ndarray:
+    return pixels[:, 1:] > pixels[:, :-1]
+
+
+def _phash_array(pixels: np.ndarray, hashsize: int) -> np.ndarray:
+    import scipy.fftpack
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=0), axis=1)
+    low_freq = dct[:hashsize, :hashsize]
+    return low_freq > np.median(low_freq)
+
+
+# hash type: (function of grayscale array, function of hash size -> array size (width, height))
+FAST_HASH_FUNC = {
+    AHASH: (_ahash_array, lambda n: (n, n)),
+    DHASH: (_dhash_array, lambda n: (n + 1, n)),
+    PHASH: (_phash_array, lambda n: (n * 4, n * 4)),
+}
+
+
+def image_hash_key(hashtype: str = DEFAULT_IMAGE_HASHTYPE, hashsize: int = DEFAULT_IMAGE_HASHSIZE, fast: bool = True):
+    """key of hashes in a hash db, hashes of `hash_image_file_fast` differ from the slow path by a few bits
+    (more in rotated variants), so they are never mixed with slow ones, e.g. imported from `imagehash.json`"""
+    key = f'{hashtype}-{hashsize}x{hashsize}'
+    return key + '-fast' if fast and hashtype in FAST_HASH_FUNC else key
+
+
+def hash_image_file_fast(
+        image_path: str,
+        hashtype: str = DEFAULT_IMAGE_HASHTYPE,
+        hashsize: int = DEFAULT_IMAGE_HASHSIZE,
+        trans: bool = True,
+):
+    """decode once (JPEG via draft mode, scaled down in DCT domain), convert to grayscale array(s) of hash size,
+    then get rotated & flipped variants by numpy transposing these tiny arrays, in the same order as
+    `hash_image_file`: original, rotate 90, 180, 270 (counterclockwise), flip left-right, flip top-bottom"""
+    hash_array_func, size_func = FAST_HASH_FUNC[hashtype]
+    w, h = size_func(hashsize)
+    im = open_image_file(image_path)
+    im.draft('L', (max(w, h) * 2, max(w, h) * 2))
+    im = im.convert('L')
+    wide = np.asarray(im.resize((w, h), Image.LANCZOS))
+    if not trans:
+        return [ImageHash(hash_array_func(wide, hashsize))]
+    tall = wide if w == h else np.asarray(im.resize((h, w), Image.LANCZOS))
+    variants_l = [wide, np.rot90(tall, 1), np.rot90(wide, 2), np.rot90(tall, 3), np.fliplr(wide), np.flipud(wide)]
+    return [ImageHash(hash_array_func(v, hashsize)) for v in variants_l]
+
+
 def hash_image_file(
         image_path: str,
         hashtype: str = DEFAULT_IMAGE_HASHTYPE,
         hash_db: dict = None,
         hashsize: int = DEFAULT_IMAGE_HASHSIZE,
         trans: bool = True,
+        fast: bool = True,
         **kwargs
 ):
     hash_func = HASH_FUNC[hashtype]
+    fast = fast and not kwargs
     if hash_db:
         try:
-            return hash_db[f'{hashtype}-{hashsize}x{hashsize}'][image_path]
+            return hash_db[image_hash_key(hashtype, hashsize, fast)][image_path]
         except KeyError:
             pass
+    if fast and hashtype in FAST_HASH_FUNC:
+        try:
+            return hash_image_file_fast(image_path, hashtype=hashtype, hashsize=hashsize, trans=trans)
+        except MemoryError:
+            pass
     im = open_image_file(image_path)
     short, long = sorted(im.size)
     in_cut = hashsize * 2
@@ -111,15 +176,163 @@ def read_imagehash_file(path: str = IMAGEHASH_FILENAME):
         return dict()
 
 
+def hex_to_hashes(hex_l: T.List[str]) -> T.List[ImageHash]:
+    """`hex_to_hash` of many square hashes at once, hex strings of the same length are unpacked in one numpy call"""
+    by_len = {}
+    for i, h in enumerate(hex_l):
+        by_len.setdefault(len(h), []).append(i)
+    r = [None] * len(hex_l)
+    for length, indexes in by_len.items():
+        n = math.isqrt(length * 4)
+        padded = length + length % 2
+        data = bytes.fromhex(''.join(hex_l[i].rjust(padded, '0') for i in indexes))
+        bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8)).astype(bool).reshape(len(indexes), padded * 4)
+        for i, a in zip(indexes, bits[:, -n * n:].reshape(-1, n, n)):
+            r[i] = ImageHash(a)
+    return r
+
+
+class ImageHashDB:
+    """image hashes in a SQLite file, each row keyed by image path and hash key (type & size),
+    and stamped with file size & mtime, so only new or changed files need to be hashed again,
+    and with a hash of the whole file content (in column `fingerprint`), so renamed or moved files reuse their hashes"""
+
+    def __init__(self, path: str = IMAGEHASH_DB_FILENAME):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('create table if not exists imagehash ('
+                                'path text, key text, size integer, mtime integer, hashes text, fingerprint text, '
+                                'primary key (path, key))')
+        columns = [row[1] for row in self.connection.execute('pragma table_info(imagehash)')]
+        if 'fingerprint' not in columns:
+            self.connection.execute('alter table imagehash add column fingerprint text')
+        self.connection.execute('create index if not exists imagehash_fingerprint on imagehash (fingerprint, key)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def load(self, key: str) -> T.Dict[str, T.Tuple[int, int, list]]:
+        """{image_path: (size, mtime_ns, [hash, ...])}"""
+        cursor = self.connection.execute('select path, size, mtime, hashes from imagehash where key=?', (key,))
+        rows = [(path, size, mtime, [h for h in hashes.split(',') if h]) for path, size, mtime, hashes in cursor]
+        hashes_iter = iter(hex_to_hashes([h for *_, hex_l in rows for h in hex_l]))
+        return {path: (size, mtime, list(itertools.islice(hashes_iter, len(hex_l)))) for path, size, mtime, hex_l in rows}
+
+    def find_by_fingerprint(self, key: str, fingerprint: str) -> T.Optional[list]:
+        """[hash, ...] of any image with the same fingerprint, or None"""
+        row = self.connection.execute('select hashes from imagehash where fingerprint=? and key=? limit 1',
+                                      (fingerprint, key)).fetchone()
+        if row:
+            return [hex_to_hash(h) for h in row[0].split(',') if h]
+
+    def update(self, key: str, rows: T.Iterable[tuple]):
+        """rows of (image_path, size, mtime_ns, [hash, ...]) or (image_path, size, mtime_ns, [hash, ...], fingerprint)"""
+        self.connection.executemany(
+            'insert or replace into imagehash (path, key, size, mtime, hashes, fingerprint) values (?, ?, ?, ?, ?, ?)',
+            [(path, key, size, mtime, ','.join(str(h) for h in hashes), fingerprint)
+             for path, size, mtime, hashes, fingerprint in ((*r, None) if len(r) == 4 else r for r in rows)])
+        self.connection.commit()
+
+    def delete(self, key: str, paths: T.Iterable[str]):
+        self.connection.executemany('delete from imagehash where path=? and key=?', [(p, key) for p in paths])
+        self.connection.commit()
+
+    def paths_without_fingerprint(self, key: str) -> T.List[str]:
+        """paths with no content hash yet, or only a sampled fingerprint of older versions"""
+        cursor = self.connection.execute("select path from imagehash where key=? and "
+                                         "(fingerprint is null or fingerprint not like '%-full:%')", (key,))
+        return [path for path, in cursor]
+
+    def set_fingerprints(self, key: str, rows: T.Iterable[T.Tuple[str, str]]):
+        """rows of (image_path, fingerprint)"""
+        self.connection.executemany('update imagehash set fingerprint=? where path=? and key=?',
+                                    [(fp, path, key) for path, fp in rows])
+        self.connection.commit()
+
+    def import_json_file(self, json_path: str = IMAGEHASH_FILENAME):
+        """migrate from the old `imagehash.json`, which has no size & mtime, so trust current files"""
+        for key, d in read_imagehash_file(json_path).items():
+            rows = []
+            for path, hashes in d.items():
+                st = os.stat(path)
+                rows.append((path, st.st_size, st.st_mtime_ns, hashes))
+            self.update(key, rows)
+
+
+def hash_all_image_files_incremental(
+        hashtype: str = DEFAULT_IMAGE_HASHTYPE,
+        hashsize: int = DEFAULT_IMAGE_HASHSIZE,
+        trans: bool = True,
+        stat: bool = True,
+        workers: int = None,
+        db_path: str = IMAGEHASH_DB_FILENAME,
+        batch_size: int = 256,
+        fast: bool = True,
+        **kwargs
+) -> dict:
+    """like `hash_all_image_files`, but only hash new or changed files (by size & mtime), in a process pool,
+    results are saved in `ImageHashDB` batch by batch, so an interrupted run keeps its progress,
+    and renamed or moved files are matched by content hash instead of hashed again"""
+    key = image_hash_key(hashtype, hashsize, fast and not kwargs)
+    new_db = not os.path.isfile(db_path)
+    with ImageHashDB(db_path) as hdb:
+        if new_db and os.path.isfile(IMAGEHASH_FILENAME):
+            hdb.import_json_file(IMAGEHASH_FILENAME)
+        known = hdb.load(key)
+        images_l = list_all_image_files()
+        stamps = {}
+        for f in images_l:
+            st = os.stat(f)
+            stamps[f] = st.st_size, st.st_mtime_ns
+        dk = {f: known[f][2] for f in images_l if f in known and known[f][:2] == stamps[f]}
+        hdb.set_fingerprints(key, [(f, file_content_hash(f)) for f in hdb.paths_without_fingerprint(key) if f in dk])
+        todo = [f for f in images_l if f not in dk]
+        fingerprints = {f: file_content_hash(f) for f in todo}
+        reused = []
+        for f in todo:
+            hashes = hdb.find_by_fingerprint(key, fingerprints[f])
+            if hashes is not None:
+                dk[f] = hashes
+                reused.append((f, *stamps[f], hashes, fingerprints[f]))
+        hdb.update(key, reused)
+        hdb.delete(key, [f for f in known if f not in stamps])
+        todo = [f for f in todo if f not in dk]
+        total_cnt, effect_cnt = len(images_l), 0
+        if todo:
+            hash_one = functools.partial(hash_image_file, hashtype=hashtype, hashsize=hashsize, trans=trans, fast=fast,
+                                         **kwargs)
+            with ProcessPoolExecutor(workers) as executor:
+                for i in range(0, len(todo), batch_size):
+                    batch = todo[i:i + batch_size]
+                    hashes_l = list(executor.map(hash_one, batch, chunksize=8))
+                    hdb.update(key, [(f, *stamps[f], h, fingerprints[f]) for f, h in zip(batch, hashes_l)])
+                    dk.update(zip(batch, hashes_l))
+                    effect_cnt += len(batch)
+                    if stat:
+                        print('hash:', percentage((total_cnt - len(todo) + effect_cnt) / total_cnt), total_cnt,
+                              total_cnt - len(todo) + effect_cnt, effect_cnt, end='\r')
+        if stat:
+            print()
+    return {key: dk}
+
+
 def hash_all_image_files(
         hash_db: dict = None,
         hashtype: str = DEFAULT_IMAGE_HASHTYPE,
         hashsize: int = DEFAULT_IMAGE_HASHSIZE,
         trans: bool = True,
         stat: bool = True,
+        fast: bool = True,
         **kwargs
 ):
-    key = f'{hashtype}-{hashsize}x{hashsize}'
+    key = image_hash_key(hashtype, hashsize, fast and not kwargs)
     db = hash_db or {key: {}}
     dk = db[key]
     images_l = list_all_image_files()
@@ -127,7 +340,7 @@ def hash_all_image_files(
     total_cnt = len(images_l)
     for f in images_l:
         if f not in dk:
-            dk[f] = hash_image_file(f, hashtype=hashtype, hashsize=hashsize, trans=trans, **kwargs)
+            dk[f] = hash_image_file(f, hashtype=hashtype, hashsize=hashsize, trans=trans, fast=fast, **kwargs)
             if stat:
                 effect_cnt += 1
         if stat:
@@ -143,17 +356,139 @@ def diff_image_hash_list(hash_list1: list, hash_list2: list):
     return diff
 
 
+if hasattr(np, 'bitwise_count'):
+    popcount_uint64 = np.bitwise_count
+else:
+    _POPCOUNT_UINT8_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount_uint64(x: np.ndarray) -> np.ndarray:
+        x = np.ascontiguousarray(x, dtype=np.uint64)
+        return _POPCOUNT_UINT8_TABLE[x.view(np.uint8)].reshape(*x.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+
+def pack_image_hashes(hash_dict: dict) -> T.Tuple[list, np.ndarray]:
+    """pack {image_path: [ImageHash, ...]} into image paths and an uint64 array of shape (images, variants, words)
+
+    shorter hash lists are padded with their first hash, which does not change the min distance"""
+    images = [k for k, v in hash_dict.items() if v]
+    if not images:
+        return [], np.zeros((0, 1, 1), dtype=np.uint64)
+    variants_n = max(len(hash_dict[k]) for k in images)
+    bits = np.array([[h.hash.flatten() for h in hash_dict[k]] + [hash_dict[k][0].hash.flatten()] * (
+            variants_n - len(hash_dict[k])) for k in images], dtype=bool)
+    pad_bits = -bits.shape[-1] % 64
+    if pad_bits:
+        bits = np.concatenate([bits, np.zeros((*bits.shape[:-1], pad_bits), dtype=bool)], axis=-1)
+    packed = np.packbits(bits, axis=-1)
+    return images, packed.view('>u8').astype(np.uint64)
+
+
+def min_variants_hamming_distance(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """a, b: packed hashes of shape (pairs, variants, words) -> min distance among all variant pairs, shape (pairs,)"""
+    x = a[:, :, None, :] ^ b[:, None, :, :]
+    return popcount_uint64(x).sum(axis=-1, dtype=np.int32).min(axis=(1, 2))
+
+
+def _iter_group_pairs(starts, counts, g1, g2, max_pairs):
+    """cartesian products of members of group g1[i] and group g2[i], in batches of about `max_pairs`"""
+    sizes = counts[g1].astype(np.int64) * counts[g2]
+    cut = 0
+    while cut < len(sizes):
+        end = cut + max(1, int(np.searchsorted(np.cumsum(sizes[cut:]), max_pairs, side='right')))
+        a_starts, b_starts = starts[g1[cut:end]], starts[g2[cut:end]]
+        b_counts, batch_sizes = counts[g2[cut:end]], sizes[cut:end]
+        rep = np.repeat(np.arange(end - cut), batch_sizes)
+        offset = np.arange(batch_sizes.sum()) - np.repeat(np.cumsum(batch_sizes) - batch_sizes, batch_sizes)
+        yield a_starts[rep] + offset // b_counts[rep], b_starts[rep] + offset % b_counts[rep]
+        cut = end
+
+
+def iter_similar_pairs_multi_index(hashes: np.ndarray, max_diff: int, max_pairs=1 << 22):
+    """multi-index hashing on 16-bit substrings
+
+    if two hashes are within `max_diff` bits, at least one of their substrings are within `max_diff // substrings`
+    bits, so only (variant, variant) pairs sharing such a substring are compared, then yield arrays of
+    (image index, image index, distance) of those within `max_diff`
+    the closest variant pair of two similar images is always among the compared, so min distance is exact"""
+    n, k, w = hashes.shape
+    substrings_n = w * 4
+    sub_radius = max_diff // substrings_n
+    masks = [sum(1 << b for b in bits) for r in range(sub_radius + 1) for bits in combinations(range(16), r)]
+    owners = np.repeat(np.arange(n), k)
+    flat = hashes.reshape(n * k, w)
+    for c in range(substrings_n):
+        keys = ((flat[:, c // 4] >> np.uint64(16 * (c % 4))) & np.uint64(0xFFFF)).astype(np.int64)
+        order = np.argsort(keys, kind='stable')
+        uniq, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+        for mask in masks:
+            partner = uniq ^ mask
+            pos = np.searchsorted(uniq, partner).clip(max=len(uniq) - 1)
+            hit = uniq[pos] == partner
+            g1, g2 = np.nonzero(hit)[0], pos[hit]
+            if mask:
+                g1, g2 = g1[g1 < g2], g2[g1 < g2]
+            for ai, bi in _iter_group_pairs(starts, counts, g1, g2, max_pairs):
+                a, b = order[ai], order[bi]
+                i, j = owners[a], owners[b]
+                d = popcount_uint64(flat[a] ^ flat[b]).sum(axis=-1, dtype=np.int32)
+                keep = (i != j) & (d <= max_diff)
+                i, j, d = i[keep], j[keep], d[keep]
+                yield np.minimum(i, j), np.maximum(i, j), d
+
+
+def iter_similar_pairs_brute_force(hashes: np.ndarray, max_diff: int, max_pairs=1 << 20):
+    n = len(hashes)
+    block = max(1, max_pairs // max(n, 1))
+    for i0 in range(0, n, block):
+        lo, hi = np.meshgrid(np.arange(i0, min(i0 + block, n)), np.arange(n), indexing='ij')
+        keep = lo < hi
+        lo, hi = lo[keep], hi[keep]
+        d = min_variants_hamming_distance(hashes[lo], hashes[hi])
+        keep = d <= max_diff
+        yield lo[keep], hi[keep], d[keep]
+
+
+def find_similar_pairs_vectorized(hash_dict: dict, max_diff: int) -> T.Tuple[list, np.ndarray]:
+    """return image paths and an int array of rows (image index, image index, distance), sorted by index"""
+    images, hashes = pack_image_hashes(hash_dict)
+    n, k, w = hashes.shape
+    sub_radius = max_diff // (w * 4)
+    if sum(math.comb(16, r) for r in range(sub_radius + 1)) <= 1000:
+        found = iter_similar_pairs_multi_index(hashes, max_diff)
+    else:
+        found = iter_similar_pairs_brute_force(hashes, max_diff)
+    rows = [np.stack([lo, hi, d], axis=-1).astype(np.int64) for lo, hi, d in found if len(lo)]
+    if not rows:
+        return images, np.zeros((0, 3), dtype=np.int64)
+    rows = np.concatenate(rows)
+    rows = rows[np.lexsort((rows[:, 2], rows[:, 1], rows[:, 0]))]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = np.any(rows[1:, :2] != rows[:-1, :2], axis=-1)
+    return images, rows[first]
+
+
 def pair_similar_images(
         hash_db: dict,
         threshold: float = 0.8,
         hashtype: str = DEFAULT_IMAGE_HASHTYPE,
         hashsize: int = DEFAULT_IMAGE_HASHSIZE,
         stat: bool = True,
+        vectorized: bool = True,
+        fast: bool = True,
         **kwargs
 ):
     max_diff = ist2hd(threshold, hashsize=hashsize)
+    key = image_hash_key(hashtype, hashsize, fast)
+    if vectorized:
+        diff_pairs_ll = [list() for _ in range(max_diff + 1)]
+        images, pairs = find_similar_pairs_vectorized(hash_db[key], max_diff)
+        for i, j, diff in pairs.tolist():
+            diff_pairs_ll[diff].append((images[i], images[j]))
+        if stat:
+            print('diff:', len(images), len(pairs))
+        return diff_pairs_ll
     diff_pairs_ll = []
-    dm = hash_db[f'{hashtype}-{hashsize}x{hashsize}']
+    dm = hash_db[key]
     for _ in range(max_diff + 1):
         diff_pairs_ll += [list()]
     image_pairs_l = [c for c in combinations(dm, 2)]
@@ -185,8 +520,8 @@ def group_similar_images(
     round_cnt, total_cnt = 0, len(pairs_l)
     for pair in pairs_l:
         groups_ds.union(*pair)
-        if stat:
-            round_cnt += 1
+        round_cnt += 1
+        if stat and (round_cnt % 1000 == 0 or round_cnt == total_cnt):
             print('group:', percentage(round_cnt / total_cnt), total_cnt, round_cnt, len(list(groups_ds.itersets())),
                   end='\r')
     if stat:
@@ -231,15 +566,16 @@ def view_similar_images_auto(
         trans: bool = True,
         stat: bool = True,
         dryrun: bool = False,
+        workers: int = None,
+        fast: bool = True,
         **kwargs
 ):
     thresholds = thresholds or [1, 0.95, 0.9, 0.85]
     thresholds.sort(reverse=True)
     hashtype = hashtype or DEFAULT_IMAGE_HASHTYPE
     hashsize = hashsize or DEFAULT_IMAGE_HASHSIZE
-    common_kwargs = {'hashtype': hashtype, 'hashsize': hashsize, 'trans': trans, 'stat': stat}
-    db = hash_all_image_files(hash_db=read_imagehash_file(), **common_kwargs)
-    write_imagehash_file(db)
+    common_kwargs = {'hashtype': hashtype, 'hashsize': hashsize, 'trans': trans, 'stat': stat, 'fast': fast}
+    db = hash_all_image_files_incremental(workers=workers, **common_kwargs)
     similar_pairs_ll = pair_similar_images(db, min(thresholds), **common_kwargs)
     hd_l = [ist2hd(th, hashsize=hashsize) for th in thresholds]
     hd_l.sort()
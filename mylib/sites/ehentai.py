@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
+import concurrent.futures
 import json
+import sqlite3
 import zipfile
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED
 
 import requests
+import requests.adapters
 
 from mylib.__deprecated__ import get_re_groups
 from mylib.easy import *
 from mylib.easy import logging
 from mylib.easy.tricks import is_hex
 from mylib.ex import fstk
-from mylib.web_client import cookies_dict_from_netscape_file, get_html_element_tree
+from mylib.web_client import cookies_dict_from_netscape_file, get_html_element_tree, TokenBucket
 
 VARIOUS = '(various)'
 UNKNOWN = '(unknown)'
@@ -60,115 +64,157 @@ def guess_creators_from_ehentai_title(x: str):
         return [creators_str]
 
 
-def ehviewer_images_catalog(root_dir, *, dry_run: bool = False, db_json_path: str = 'ehdb.json'):
+def ehviewer_catalog_folder(title: str, tags: dict):
+    """(folder by creators or magazine, core title) of a gallery"""
+    creators = []
+    title = title.strip()
+    try:
+        core_title = find_core_title(title) or '__INVALID_CORE_TITLE__'
+        core_title_l = re.findall(r'[\w]+[\-+\']?[\w]?', core_title)
+        if title[:1] + title[-1:] == '[]':
+            creators.append(title[1:-1].strip())
+    except AttributeError:
+        print('! {}'.format(title))
+        raise
+    comic_magazine_title = None
+    if core_title_l and core_title_l[0].lower() == 'comic':
+        comic_magazine_title_l = []
+        for s in core_title_l[1:]:
+            if re.match(r'^\d+', s):
+                break
+            elif re.match(r'^(?:vol|no\.|#)(.*)$', s.lower()):
+                break
+            else:
+                comic_magazine_title_l.append(s)
+        if comic_magazine_title_l:
+            comic_magazine_title = 'COMIC ' + ' '.join(comic_magazine_title_l)
+
+    if 'artist' in tags:
+        creators = tags['artist']
+    elif 'group' in tags:
+        creators = tags['group']
+    else:
+        creators = guess_creators_from_ehentai_title(title)
+        if creators:
+            core_title = title
+        # todo: clean below code block if guess_creators_from_ehentai_title work well
+        # for m in (
+        #         re.match(r'^(?:\([^)]+\))\s*\[([^]]+)]', title),
+        #         re.match(r'^\[(?:pixiv|fanbox|tumblr|twitter)]\s*(.+)\s*[(\[]', title, flags=re.I),
+        #         re.match(r'^\W*artist\W*(\w.*)', title, flags=re.I),
+        # ):
+        #     if m:
+        #         m1 = m.group(1).strip()
+        #         if m1:
+        #             if '|' in m1:
+        #                 creators = [e.strip() for e in m1.split('|')]
+        #             else:
+        #                 creators = [m1]
+        #             core_title = title
+        #         break
+    if comic_magazine_title:
+        folder = comic_magazine_title.replace('COMIC X-E ROS', 'COMIC X-EROS')
+    elif creators:
+        if len(creators) > 3:
+            folder = VARIOUS
+        else:
+            folder = ', '.join(creators)
+    else:
+        folder = UNKNOWN
+    # print(f': {title}')  # DEBUG
+    # print(f': {core_title}')  # DEBUG
+    return folder, core_title
+
+
+def ehviewer_images_catalog(root_dir, *, dry_run: bool = False, db_path: str = 'ehdb.sqlite',
+                            db_json_path: str = 'ehdb.json', save_every: int = 100, workers: int = None):
+    """sort images downloaded by ehviewer into folders of creators & galleries, in phases:
+    scan file names, fetch missing gallery data, plan folders of galleries (in `workers` processes), move files
+
+    `db_json_path`: old JSON DB file, migrated into `db_path` (SQLite) if the latter does not exist yet"""
     logger = logging.get_logger('ehvimg', fmt=logging.LOG_FMT_MESSAGE_ONLY)
     logmsg_move = '* move {} -> {}'
     logmsg_skip = '# skip {}'
     logmsg_data = '+ /g/{}/{}'
     logmsg_err = '! {}'
-
-    if os.path.isfile(db_json_path):
-        logger.info('@ using DB file: {}'.format(db_json_path))
-        db = fstk.read_json_file(db_json_path)
-        db = {int(k): v for k, v in db.items()}
-    else:
-        db = {}
-
-    with fstk.ctx_pushd(root_dir):
-        not_found_gid_token = []
-        files = []
-        for f in next(os.walk('.'))[-1]:
-            try:
-                g = EHentaiGallery(f, logger=logger)
-            except ValueError:
-                logger.info(logmsg_skip.format(f))
-                continue
-            if g.gid not in db and (g.gid, g.token) not in not_found_gid_token:
-                not_found_gid_token.append((g.gid, g.token))
-                print(logmsg_data.format(g.gid, g.token))
-            files.append(f)
-
-        if not_found_gid_token:
-            print('... RETRIEVE GALLERY DATA FROM E-HENTAI API ...')
-            print('... IT WILL TAKE A LONG TIME ...')
-            eh_api = EHentaiAPI()
-            for d in eh_api.get_gallery_data(not_found_gid_token):
-                db[d['gid']] = d
-            fstk.write_json_file(db_json_path, db, indent=4)
-
-        for f in files:
-            g = EHentaiGallery(f, logger=logger)
-            d = db[g.gid]
-            creators = []
-            title = d['title'].strip()
-            try:
-                core_title = find_core_title(title) or '__INVALID_CORE_TITLE__'
-                core_title_l = re.findall(r'[\w]+[\-+\']?[\w]?', core_title)
-                if title[:1] + title[-1:] == '[]':
-                    creators.append(title[1:-1].strip())
-            except AttributeError:
-                print(logmsg_err.format(title))
-                raise
-            comic_magazine_title = None
-            if core_title_l and core_title_l[0].lower() == 'comic':
-                comic_magazine_title_l = []
-                for s in core_title_l[1:]:
-                    if re.match(r'^\d+', s):
-                        break
-                    elif re.match(r'^(?:vol|no\.|#)(.*)$', s.lower()):
-                        break
-                    else:
-                        comic_magazine_title_l.append(s)
-                if comic_magazine_title_l:
-                    comic_magazine_title = 'COMIC ' + ' '.join(comic_magazine_title_l)
-
-            tags = d['tags']
-
-            if 'artist' in tags:
-                creators = tags['artist']
-            elif 'group' in tags:
-                creators = tags['group']
+    timings = {}
+
+    new_db = not os.path.isfile(db_path)
+    with EHentaiDB(db_path) as db:
+        if new_db and os.path.isfile(db_json_path):
+            logger.info('@ migrate DB file: {} -> {}'.format(db_json_path, db_path))
+            db.import_json_file(db_json_path)
+        logger.info('@ using DB file: {}'.format(db_path))
+        with fstk.ctx_pushd(root_dir):
+            t = time.perf_counter()
+            galleries = {}
+            for f in next(os.walk('.'))[-1]:
+                try:
+                    galleries[f] = EHentaiGallery(f, logger=logger)
+                except ValueError:
+                    logger.info(logmsg_skip.format(f))
+            gid_token_d = {g.gid: (g.gid, g.token) for g in galleries.values()}
+            missing = db.missing(gid_token_d)
+            not_found_gid_token = [gid_token_d[gid] for gid in gid_token_d if gid in missing]
+            for gid, token in not_found_gid_token:
+                print(logmsg_data.format(gid, token))
+            timings['scan'] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            if not_found_gid_token:
+                total = len(not_found_gid_token)
+                logger.info('@ retrieve data of {} galleries from e-hentai API'.format(total))
+                eh_api = EHentaiAPI()
+                n = 0
+                buffer = []
+                try:
+                    for d in eh_api.iter_gallery_data(not_found_gid_token):
+                        if 'error' in d:
+                            logger.info(logmsg_err.format('/g/{}: {}'.format(d.get('gid'), d['error'])))
+                            continue
+                        buffer.append(d)
+                        n += 1
+                        if len(buffer) >= save_every:
+                            db.upsert(buffer)
+                            buffer = []
+                            logger.info('@ {}/{} galleries'.format(n, total))
+                finally:  # keep what has arrived, even if interrupted
+                    db.upsert(buffer)
+            timings['fetch'] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            data = db.get_many(gid_token_d)
+            gids = list(data)
+            titles_tags = [(data[gid]['title'], data[gid]['tags']) for gid in gids]
+            if workers == 1 or len(gids) < 2:
+                folders = list(itertools.starmap(ehviewer_catalog_folder, titles_tags))
             else:
-                creators = guess_creators_from_ehentai_title(title)
-                if creators:
-                    core_title = title
-                # todo: clean below code block if guess_creators_from_ehentai_title work well
-                # for m in (
-                #         re.match(r'^(?:\([^)]+\))\s*\[([^]]+)]', title),
-                #         re.match(r'^\[(?:pixiv|fanbox|tumblr|twitter)]\s*(.+)\s*[(\[]', title, flags=re.I),
-                #         re.match(r'^\W*artist\W*(\w.*)', title, flags=re.I),
-                # ):
-                #     if m:
-                #         m1 = m.group(1).strip()
-                #         if m1:
-                #             if '|' in m1:
-                #                 creators = [e.strip() for e in m1.split('|')]
-                #             else:
-                #                 creators = [m1]
-                #             core_title = title
-                #         break
-            if comic_magazine_title:
-                folder = comic_magazine_title.replace('COMIC X-E ROS', 'COMIC X-EROS')
-            elif creators:
-                if len(creators) > 3:
-                    folder = VARIOUS
+                with ProcessPoolExecutor(workers) as executor:
+                    folders = list(executor.map(ehviewer_catalog_folder, *zip(*titles_tags), chunksize=64))
+            sub_folders = {gid: fstk.make_path(fstk.sanitize_xu200(folder),
+                                               f'{fstk.sanitize_xu200(core_title)} {gid}-{gid_token_d[gid][1]}')
+                           for gid, (folder, core_title) in zip(gids, folders)}
+            plan = []
+            for f, g in galleries.items():
+                sub_folder = sub_folders.get(g.gid)
+                if not sub_folder:
+                    logger.info(logmsg_skip.format(f))
+                    continue
+                no_ext, ext = os.path.splitext(f)
+                no_ext = fstk.sanitize_xu240(no_ext.split()[-1])
+                plan.append((f, fstk.make_path(sub_folder, no_ext + ext)))
+            timings['plan'] = time.perf_counter() - t
+
+            def log_move(src, dst, error):
+                if error:
+                    logger.info(logmsg_err.format(f'{src}: {error!r}'))
                 else:
-                    folder = ', '.join(creators)
-            else:
-                folder = UNKNOWN
-            # print(f': {title}')  # DEBUG
-            # print(f': {core_title}')  # DEBUG
-
-            sub_folder = fstk.make_path(fstk.sanitize_xu200(folder),
-                                        f'{fstk.sanitize_xu200(core_title)} {g.gid}-{g.token}')
-            parent, basename = os.path.split(f)
-            no_ext, ext = os.path.splitext(basename)
-            no_ext = fstk.sanitize_xu240(no_ext.split()[-1])
-            new_path = fstk.make_path(sub_folder, no_ext + ext)
-            logger.info(logmsg_move.format(f, new_path))
-            if not dry_run:
-                os.makedirs(sub_folder, exist_ok=True)
-                shutil.move(f, new_path)
+                    logger.info(logmsg_move.format(src, dst))
+
+            t = time.perf_counter()
+            fstk.move_by_plan(plan, dry_run=dry_run, callback=log_move)
+            timings['move'] = time.perf_counter() - t
+    logger.info('@ {} files, {}'.format(len(plan), ', '.join(f'{k} {v:.2f}s' for k, v in timings.items())))
 
 
 class EHentaiGallery:
@@ -344,16 +390,24 @@ class EHentaiError(Exception):
             return 'EHentai Error {}: {}'.format(self.code, self.reason)
 
 
-def ehviewer_dl_folder_rename(folder_path: str, *, db: dict = None, update_db=False):
-    db = db or {}
+def ehviewer_dl_folder_rename(folder_path: str, *, db: T.Union[dict, 'EHentaiDB'] = None, update_db=False):
+    """`db`: `EHentaiDB`, or dict of {gid str: data}"""
+    db = {} if db is None else db
     with fstk.ctx_pushd(folder_path):
         with open('.ehviewer') as info_file:
             info_lines = info_file.readlines()
     gid = info_lines[2].strip()
     token = info_lines[3].strip()
-    d = db.get(gid) or EHentaiGallery(f'{gid}/{token}').data
-    if update_db:
-        db[gid] = d
+    if isinstance(db, EHentaiDB):
+        d = db.get(int(gid))
+        if not d:
+            d = EHentaiGallery(f'{gid}/{token}').data
+            if update_db:
+                db.upsert([d])
+    else:
+        d = db.get(gid) or EHentaiGallery(f'{gid}/{token}').data
+        if update_db:
+            db[gid] = d
     title = d.get('title') or d.get('original title')
     if not title:
         return
@@ -402,6 +456,13 @@ def parse_hentai_at_home_downloaded_gallery_info(gallery_path, gallery_type=''):
             tags['misc'].append(e)
     d['tags'] = tags
     d['uploader comments'] = cmt.strip() if cmt is not None else None
+    d.update(parse_hentai_at_home_gallery_name(gallery_path))
+    return d
+
+
+def parse_hentai_at_home_gallery_name(gallery_path):
+    """gid_resize, gid & resize from the tail of H@H downloaded gallery name, without reading its content"""
+    d = {}
     root_dir, name, ext = split_path_dir_base_ext(gallery_path, dir_ext=False)
     try:
         gid_resize = re.search(r' \[\d+(-\d{3,4}x)?]$', name).group(0)
@@ -437,15 +498,138 @@ def refine_tags_in_dict(d: dict):
     return d
 
 
+class EHentaiDB:
+    """gallery metadata in a SQLite file, keyed by gid, shared by the API catalog, H@H sort & ehviewer rename,
+    with tags (artist, group, ...) and title words indexed for lookups"""
+
+    def __init__(self, path: str = 'ehdb.sqlite'):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            'create table if not exists gallery (gid integer primary key, token text, title text, data text);'
+            'create table if not exists gallery_tag (gid integer, namespace text, tag text);'
+            'create index if not exists gallery_tag_gid on gallery_tag (gid);'
+            'create index if not exists gallery_tag_tag on gallery_tag (namespace, tag);'
+            'create table if not exists title_word (gid integer, word text);'
+            'create index if not exists title_word_gid on title_word (gid);'
+            'create index if not exists title_word_word on title_word (word);')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('select count(*) from gallery').fetchone()[0]
+
+    def __contains__(self, gid: int):
+        return self.connection.execute('select 1 from gallery where gid=?', (gid,)).fetchone() is not None
+
+    @staticmethod
+    def title_words(title: str):
+        return set(re.findall(r'\w+', title.lower()))
+
+    def upsert(self, data_l: T.Iterable[dict]):
+        """insert or update galleries (dicts with 'gid'), new keys are merged into the stored data"""
+        data_l = list(data_l)
+        old = self.get_many(int(d['gid']) for d in data_l)
+        galleries, tags, words = {}, [], []
+        for d in data_l:
+            gid = int(d['gid'])
+            d = {**old[gid], **d} if gid in old else d
+            old[gid] = d  # the same gid again in this batch
+            title = d.get('title') or ''
+            galleries[gid] = gid, d.get('token'), title, json.dumps(d, ensure_ascii=False)
+        for gid, (_, _, title, _) in galleries.items():
+            d = old[gid]
+            tags.extend((gid, ns, tag) for ns, tag_l in (d.get('tags') or {}).items() for tag in tag_l)
+            words.extend((gid, w) for w in self.title_words(title))
+        c = self.connection
+        gids = [(gid,) for gid in galleries]
+        c.executemany('delete from gallery_tag where gid=?', gids)
+        c.executemany('delete from title_word where gid=?', gids)
+        c.executemany('insert or replace into gallery (gid, token, title, data) values (?, ?, ?, ?)',
+                      galleries.values())
+        c.executemany('insert into gallery_tag (gid, namespace, tag) values (?, ?, ?)', tags)
+        c.executemany('insert into title_word (gid, word) values (?, ?)', words)
+        c.commit()
+
+    def get(self, gid: int) -> T.Optional[dict]:
+        row = self.connection.execute('select data from gallery where gid=?', (gid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, gids: T.Iterable[int]) -> T.Dict[int, dict]:
+        gids = list(set(gids))
+        r = {}
+        for i in range(0, len(gids), 500):
+            chunk = gids[i:i + 500]
+            cursor = self.connection.execute(
+                'select gid, data from gallery where gid in ({})'.format(','.join('?' * len(chunk))), chunk)
+            r.update((gid, json.loads(data)) for gid, data in cursor)
+        return r
+
+    def missing(self, gids: T.Iterable[int]) -> set:
+        gids = set(gids)
+        return gids - set(self.get_many(gids))
+
+    def find_by_tag(self, namespace: str, tag: str) -> T.List[int]:
+        cursor = self.connection.execute('select distinct gid from gallery_tag where namespace=? and tag=?',
+                                         (namespace, tag))
+        return [gid for gid, in cursor]
+
+    def find_by_title(self, words: str) -> T.List[int]:
+        """gids of galleries with all the words in title"""
+        words = self.title_words(words)
+        if not words:
+            return []
+        cursor = self.connection.execute(
+            'select gid from title_word where word in ({}) group by gid having count(distinct word)=?'.format(
+                ','.join('?' * len(words))), (*words, len(words)))
+        return [gid for gid, in cursor]
+
+    def import_json_file(self, json_path: str = 'ehdb.json'):
+        """migrate from the old JSON DB file: {gid: data}"""
+        db = fstk.read_json_file(json_path)
+        self.upsert({**d, 'gid': int(k)} for k, d in db.items())
+
+
 class EHentaiAPI:
+    """e-hentai JSON API client, requests are paced by a token bucket (`rate` per second, `burst` at most),
+    with a few batches in flight over one keep-alive session"""
     API_URL = 'https://api.e-hentai.org/api.php'
     max_entries = 25
     interval = 1
+    burst = 4
+    max_in_flight = 2
+    retries = 3
+
+    def __init__(self, rate: float = None, burst: int = None, max_in_flight: int = None, retries: int = None):
+        self.rate = rate or 1 / self.interval
+        self.burst = burst or self.burst
+        self.max_in_flight = max_in_flight or self.max_in_flight
+        self.retries = self.retries if retries is None else retries
+        self.logger = logging.get_logger(f'{__name__}.api')
+        self.bucket = TokenBucket(self.rate, self.burst)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_in_flight)
+        self.session.mount('https://', adapter)
 
     def post(self, j):
-        r = requests.post(self.API_URL, json=j)
-        sleep(self.interval)
-        return r.json()
+        """the ban notice comes as plain text (with 200 or an error status), raise it as `EHentaiError` (403)"""
+        self.bucket.consume()
+        r = self.session.post(self.API_URL, json=j)
+        if r.text.lstrip().startswith('Your IP address has been temporarily banned'):
+            raise EHentaiError(r.text.strip())
+        r.raise_for_status()
+        try:
+            return r.json()
+        except ValueError:
+            raise EHentaiError(r.text.strip())
 
     def split_entries(self, entries):
         entries_n = len(entries)
@@ -456,14 +640,37 @@ class EHentaiAPI:
             return [list(entries)]
         return [entries[i * self.max_entries:(i + 1) * self.max_entries] for i in range(groups_n)]
 
+    def post_gdata(self, entries):
+        j = self.post({'method': 'gdata', 'namespace': 1, 'gidlist': entries})
+        if 'error' in j:
+            raise EHentaiError(j['error'])
+        return [refine_tags_in_dict(d) for d in j['gmetadata']]
+
+    def iter_gallery_data(self, gid_token_tuples):
+        """yield gallery data as soon as its batch arrives (not in the input order),
+        a failed batch is retried on its own, up to `retries` times, while other batches go on"""
+        batches = deque((entries, 0) for entries in self.split_entries(list(gid_token_tuples)))
+        pending = {}
+        with ThreadPoolExecutor(self.max_in_flight) as executor:
+            while batches or pending:
+                while batches and len(pending) < self.max_in_flight:
+                    entries, tries = batches.popleft()
+                    pending[executor.submit(self.post_gdata, entries)] = entries, tries
+                done, _ = concurrent.futures.wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entries, tries = pending.pop(future)
+                    try:
+                        data_l = future.result()
+                    except (requests.RequestException, ValueError, EHentaiError) as e:
+                        if tries >= self.retries or isinstance(e, EHentaiError) and e.code == 403:
+                            raise
+                        self.logger.warning(f'retry batch of {len(entries)} galleries: {e!r}')
+                        batches.append((entries, tries + 1))
+                        continue
+                    yield from data_l
+
     def get_gallery_data(self, gid_token_tuples):
-        data_l = []
-        for entries in self.split_entries(gid_token_tuples):
-            j = self.post({'method': 'gdata', 'namespace': 1, 'gidlist': entries})
-            if 'error' in j:
-                raise EHentaiError('error')
-            data_l.extend([refine_tags_in_dict(d) for d in j['gmetadata']])
-        return data_l
+        return list(self.iter_gallery_data(gid_token_tuples))
 
     def get_gallery_data_single(self, gid, token):
         return self.post({'method': 'gdata', 'namespace': 1, 'gidlist': [[gid, token]]})
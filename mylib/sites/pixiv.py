@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 # encoding=utf8
 
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+import requests.adapters
 from mylib.ex.fstk import write_json_file, sanitize_xu
 from mylib.easy import *
 from mylib.easy.logging import get_logger
 from mylib.ex.tricks import AttributeInflection
 from mylib.easy.tricks import Attreebute, width_of_int
-from mylib.web_client import HTTPResponseInspection, parse_https_url, make_requests_kwargs, DownloadPool
+from mylib.web_client import HTTPResponseInspection, parse_https_url, make_requests_kwargs, DownloadPool, \
+    JSONResponseCache
 
 FANBOX_DOMAIN = 'fanbox.cc'
 FANBOX_HOMEPAGE = 'https://' + FANBOX_DOMAIN
@@ -81,44 +85,75 @@ class PixivFanboxPost(Attreebute, AttributeInflection):
 
 
 class PixivFanboxAPI:
-    def __init__(self, **kwargs_for_requests):
+    crawl_page_limit = 10
+
+    def __init__(self, cache_dir: str = None, max_age: float = 0, workers: int = 8, **kwargs_for_requests):
+        """`cache_dir`: folder to cache JSON responses in, revalidated by ETag, no cache if not set
+        `max_age`: seconds to use a cached response without revalidating it (lists of posts are always revalidated)
+        `workers`: concurrent requests of post info in `iter_post_info`, over one keep-alive session"""
         self.api_url = FANBOX_API_URL
         self.kwargs_for_requests = make_requests_kwargs(**kwargs_for_requests)
         self.kwargs_for_requests['headers']['Origin'] = FANBOX_HOMEPAGE
-
-    def get(self, url, params=None):
-        r = requests.get(url, params=params, **self.kwargs_for_requests)
-        logger.debug(r.request.url)
-        if r.ok:
+        self.workers = workers
+        self.cache = JSONResponseCache(cache_dir, max_age) if cache_dir else None
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, params=None, max_age=None):
+        if self.cache:
+            d = self.cache.get(self.session, url, params, max_age=max_age, **self.kwargs_for_requests)
+        else:
+            r = self.session.get(url, params=params, **self.kwargs_for_requests)
+            logger.debug(r.request.url)
+            if not r.ok:
+                raise HTTPResponseInspection(r)
             d = r.json()
-            if len(d) == 1 and S_BODY in d:
-                return d[S_BODY]
-            else:
-                return d
+        if len(d) == 1 and S_BODY in d:
+            return d[S_BODY]
         else:
-            raise HTTPResponseInspection(r)
+            return d
 
-    def get_post_info(self, post_id):
+    def get_post_info(self, post_id, updated: str = None):
+        """`updated`: `updatedDatetime` of the post in a list, if the cached post has the same, it is used as is"""
         url = self.api_url + '/post.info'
         params = {'postId': post_id}
+        if self.cache and updated:
+            entry = self.cache.load(url, params)
+            if entry and entry['data'].get(S_BODY, {}).get('updatedDatetime') == updated:
+                return PixivFanboxPost(entry['data'][S_BODY])
         return PixivFanboxPost(self.get(url, params))
 
+    def iter_post_info(self, post_items: T.Iterable[dict]):
+        """full posts of items listed by `list_post_items_of_creator`, in the same order,
+        items already with body are used as is, the others are requested in `workers` threads"""
+        def full_post(item):
+            if item.get(S_BODY) is not None:
+                return PixivFanboxPost(item)
+            return self.get_post_info(item['id'], item.get('updatedDatetime'))
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            yield from executor.map(full_post, post_items)
+
     def get_creator_info(self, creator_id):
         url = self.api_url + '/creator.get'
         params = {'creatorId': creator_id}
         return self.get(url, params)
 
-    def list_post_of_creator(self, creator_id, limit=10):
-        posts = []
+    def list_post_items_of_creator(self, creator_id, limit=10) -> T.List[dict]:
+        items = []
         url = self.api_url + '/post.listCreator'
         params = {'creatorId': creator_id, 'limit': limit}
         while url:
-            d = self.get(url, params)
-            posts.extend(d['items'])
+            d = self.get(url, params, max_age=0)
+            items.extend(d['items'])
             url = d['nextUrl']
             if url and params:
                 params = None
-        return [PixivFanboxPost(p) for p in posts]
+        return items
+
+    def list_post_of_creator(self, creator_id, limit=10):
+        return [PixivFanboxPost(p) for p in self.list_post_items_of_creator(creator_id, limit=limit)]
 
     def list_sponsor_plan_of_creator(self, creator_id) -> list:
         url = self.api_url + '/plan.listCreator'
@@ -133,7 +168,8 @@ def pixiv_fanbox_creator_folder(creator_data: dict):
 def download_pixiv_fanbox_post(post_or_id: PixivFanboxPost or dict or str or int, root_dir='.',
                                fanbox_api: PixivFanboxAPI = None,
                                download_pool: DownloadPool = None,
-                               retry=-1, **kwargs_for_requests):
+                               retry=-1, enqueue_only=False, **kwargs_for_requests):
+    """`enqueue_only`: put downloads in the queue of `download_pool`, but do not start or end its queue loop"""
     download_pool = download_pool or DownloadPool()
     if isinstance(post_or_id, PixivFanboxPost):
         post = post_or_id
@@ -169,14 +205,16 @@ def download_pixiv_fanbox_post(post_or_id: PixivFanboxPost or dict or str or int
         filepath = os.path.join(root_dir, creator_folder, post_folder, file)
         download_pool.put_download_in_queue(image.original_url, filepath, retry, **kwargs_for_requests)
 
-    download_pool.start_queue_loop()
-    download_pool.put_end_of_queue()
+    if not enqueue_only:
+        download_pool.start_queue_loop()
+        download_pool.put_end_of_queue()
 
 
 def download_pixiv_fanbox_creator(creator_id, root_dir='.',
                                   fanbox_api: PixivFanboxAPI = None,
                                   download_pool: DownloadPool = None,
-                                  retry=-1, **kwargs_for_requests):
+                                  retry=-1, enqueue_only=False, **kwargs_for_requests):
+    """`enqueue_only`: put downloads in the queue of `download_pool`, but do not start or end its queue loop"""
     download_params = {'retry': retry, **kwargs_for_requests}
     fanbox_api = fanbox_api or PixivFanboxAPI(**kwargs_for_requests)
     download_pool = download_pool or DownloadPool()
@@ -215,19 +253,27 @@ def download_pixiv_fanbox_creator(creator_id, root_dir='.',
         filepath = os.path.join(root_dir, creator_folder, file)
         download_pool.put_download_in_queue(url, filepath, **download_params)
 
-    download_pool.start_queue_loop()
-    download_pool.put_end_of_queue()
+    if not enqueue_only:
+        download_pool.start_queue_loop()
+        download_pool.put_end_of_queue()
 
 
 def download_pixiv_fanbox_creator_and_all_posts(creator_url_or_id, root_dir='.',
                                                 fanbox_api: PixivFanboxAPI = None,
                                                 download_pool: DownloadPool = None,
                                                 retry=-1, **kwargs_for_requests):
+    """posts are listed in large pages, their info requested concurrently (and cached if `fanbox_api` has a cache),
+    all files go into one download queue, which starts before the first post is listed"""
     fanbox_api = fanbox_api or PixivFanboxAPI(**kwargs_for_requests)
     download_pool = download_pool or DownloadPool()
     creator_id = fanbox_creator_id_from_url(creator_url_or_id) or creator_url_or_id
-    download_pixiv_fanbox_creator(creator_id, root_dir, fanbox_api=fanbox_api, download_pool=download_pool, retry=retry,
-                                  **kwargs_for_requests)
-    for p in fanbox_api.list_post_of_creator(creator_id):
-        download_pixiv_fanbox_post(p, root_dir, fanbox_api=fanbox_api, download_pool=download_pool, retry=retry,
-                                   **kwargs_for_requests)
+    download_pool.start_queue_loop()
+    try:
+        download_pixiv_fanbox_creator(creator_id, root_dir, fanbox_api=fanbox_api, download_pool=download_pool,
+                                      retry=retry, enqueue_only=True, **kwargs_for_requests)
+        post_items = fanbox_api.list_post_items_of_creator(creator_id, limit=fanbox_api.crawl_page_limit)
+        for p in fanbox_api.iter_post_info(post_items):
+            download_pixiv_fanbox_post(p, root_dir, fanbox_api=fanbox_api, download_pool=download_pool, retry=retry,
+                                       enqueue_only=True, **kwargs_for_requests)
+    finally:
+        download_pool.put_end_of_queue()
@@ -2,7 +2,10 @@
 # -*- coding: utf-8 -*-
 """Library for website operation"""
 
+import concurrent.futures
+import hashlib
 import json
+from array import array
 from concurrent.futures.thread import ThreadPoolExecutor
 from queue import Queue
 from urllib.parse import urlparse, ParseResult
@@ -10,12 +13,14 @@ from urllib.parse import urlparse, ParseResult
 import colorama
 import humanize
 import lxml.html
+import requests.adapters
 import requests.utils
 
 from mylib.easy.typing import JSONType
 from mylib.ex import fstk, ostk
 from .easy import *
 from mylib.ex.http_headers import CURLCookieJar
+from .easy import asyncio, logging
 from .easy.logging import get_logger, LOG_FMT_MESSAGE_ONLY
 from .easy.io import SubscriptableFileIO
 from mylib.easy.tricks import singleton, iter_factory_retry
@@ -214,7 +219,8 @@ def human_filesize(bytes_n: int, no_space=True):
 
 class Download:
     def __init__(self, response: requests.Response, filepath: str = None,
-                 content: bytes = None, no_content: bool = False):
+                 content: bytes = None, no_content: bool = False, size: int = None):
+        """`size` is the count of received bytes, only needed if `content` is not kept (e.g. streamed to file)"""
         content = b'' if no_content else content or response.content
         if not response.ok:
             raise HTTPResponseInspection(response, content)
@@ -224,7 +230,7 @@ class Download:
         self.reason = response.reason
         self.url = response.request.url
         self.data = content
-        self.size = len(self.data)
+        self.size = len(self.data) if size is None else size
         content_length = int(response.headers.get('Content-Length', '-1'))
         if content_length >= 0 and content_length != self.size:
             raise HTTPIncomplete(content_length, self.size)
@@ -283,6 +289,30 @@ class HTTPResponseInspection(Exception):
             self.size = size
             self.excerpt = '{} bytes'.format(size)
 
+    @classmethod
+    def from_aiohttp(cls, response, content: bytes = b''):
+        """inspection of an `aiohttp.ClientResponse`, whose body (if any) has been read as `content`"""
+        self = cls.__new__(cls)
+        Exception.__init__(self, response.status, response.reason, str(response.url))
+        self.version = '{}.{}'.format(*response.version) if response.version else '1.1'
+        self.code = int(response.status)
+        self.reason = str(response.reason)
+        self.json = None
+        self.size = len(content)
+        self.excerpt = content if self.size <= 32 else None
+        ct = response.headers.get('content-type', '')
+        if content and ('json' in ct or 'javascript' in ct):
+            try:
+                self.json = json.loads(content)
+            except ValueError:
+                pass
+        return self
+
+    @property
+    def is_client_error(self):
+        """4xx, except those worth retrying later (timeout, too many requests)"""
+        return 400 <= self.code < 500 and self.code not in (408, 429)
+
     def __repr__(self):
         t = 'HTTP/{} {} {}'.format(self.version, self.code, self.reason)
         if self.json:
@@ -302,22 +332,156 @@ class HTTPIncomplete(Exception):
         self.recv_size = recv_size
 
 
-@singleton
-class DownloadPool(ThreadPoolExecutor):
+class ThroughputMeter:
+    """bytes per second in a sliding time window, counted in a fixed-size array-backed ring of time slots"""
+
+    def __init__(self, window: float = 2, slots_n: int = 20):
+        self.window = window
+        self.slots_n = slots_n
+        self.resolution = window / slots_n
+        self.total = 0
+        self._bytes = array('q', [0]) * slots_n
+        self._ticks = array('q', [-1]) * slots_n
+        self._lock = threading.Lock()
+
+    def add(self, n: int):
+        tick = int(time.monotonic() / self.resolution)
+        i = tick % self.slots_n
+        with self._lock:
+            if self._ticks[i] == tick:
+                self._bytes[i] += n
+            else:
+                self._ticks[i] = tick
+                self._bytes[i] = n
+            self.total += n
+
+    @property
+    def bytes_per_sec(self) -> float:
+        """average over the complete slots in the window, the slot being filled is not counted"""
+        now = int(time.monotonic() / self.resolution)
+        oldest = now - self.slots_n + 1
+        recv = sum(n for n, tick in zip(self._bytes, self._ticks) if oldest <= tick < now)
+        return recv / (self.resolution * (self.slots_n - 1))
+
+    def eta(self, remaining: int) -> float or None:
+        rate = self.bytes_per_sec
+        if remaining < 0 or not rate:
+            return None
+        return remaining / rate
+
+
+class DownloadSegments:
+    """byte ranges of a segmented download, finished ones are recorded in a sidecar JSON file for resuming"""
+
+    def __init__(self, progress_file: str, size: int, segments_n: int):
+        self.file = progress_file
+        self.size = size
+        self.lock = threading.Lock()
+        self.failed = set()
+        d = fstk.read_json_file(progress_file) if os.path.isfile(progress_file) else {}
+        if d.get('size') == size and d.get('segments'):
+            self.segments = [tuple(seg) for seg in d['segments']]
+            self.done = set(d.get('done', []))
+        else:
+            step = -(-size // segments_n)
+            self.segments = [(start, min(start + step, size)) for start in range(0, size, step)]
+            self.done = set()
+            self.save()
+        self.pending = len(self.missing)
+
+    @property
+    def missing(self):
+        return [(i, start, stop) for i, (start, stop) in enumerate(self.segments) if i not in self.done]
+
+    @property
+    def is_complete(self):
+        return len(self.done) == len(self.segments)
+
+    def save(self):
+        fstk.write_json_file(self.file, {'size': self.size, 'segments': self.segments, 'done': sorted(self.done)})
+
+    def finish(self, index: int, ok: bool) -> bool:
+        """mark a segment as finished (or failed), return True if this is the last pending one"""
+        with self.lock:
+            if ok:
+                self.done.add(index)
+                self.save()
+            else:
+                self.failed.add(index)
+            self.pending -= 1
+            return self.pending == 0
+
+    def remove(self):
+        if os.path.isfile(self.file):
+            os.remove(self.file)
+
+
+class DownloadPoolMixin:
+    """queue and logging parts shared by `DownloadPool` and `AsyncDownloadPool`"""
     tmpfile_suffix = '.download'
+    queue: Queue
+    logger: logging.Logger
+
+    def log_file_done(self, filepath, size):
+        self.logger.info('* {} ({})'.format(filepath, human_filesize(size)))
+
+    def file_already_exists(self, filepath):
+        if os.path.isfile(filepath):
+            self.logger.info('# {}'.format(filepath))
+            return True
+        else:
+            return False
 
-    def __init__(self, threads_n: int = 5, timeout: int = 30, name: str = None, show_status: bool = True):
+    def log_new_download(self, url, filepath, retry):
+        self.logger.info('+ {} <- {} (retry={})'.format(filepath, url, retry))
+
+    def put_download_in_queue(self, url, filepath, retry, **kwargs_for_requests):
+        if self.file_already_exists(filepath):
+            return
+        self.queue.put((url, filepath, retry, kwargs_for_requests))
+        self.log_new_download(url, filepath, retry)
+
+    def put_end_of_queue(self):
+        self.queue.put(None)
+
+
+@singleton
+class DownloadPool(DownloadPoolMixin, ThreadPoolExecutor):
+    progress_file_suffix = '.segments'
+    chunk_size = 4096 * 1024
+
+    def __init__(self, threads_n: int = 5, timeout: int = 30, name: str = None, show_status: bool = True,
+                 streaming: bool = False, use_mmap: bool = False,
+                 segments_n: int = 1, segment_min_size: int = 16 * 1024 * 1024, pool_size: int = 10,
+                 status_jsonl: str = None):
+        """`streaming`: write chunks into the temp file as they arrive, never hold the whole payload in memory
+        `use_mmap`: in streaming mode, write chunks through a memory map of the preallocated temp file
+        `segments_n`: split a file (which accepts byte ranges) into this many ranges, download them in parallel
+        `segment_min_size`: files smaller than this are never split
+        `pool_size`: max kept-alive connections per host, in the session of each worker thread
+        `status_jsonl`: append a JSON line of `status()` to this file every status interval"""
         self._max_workers: int = 0
+        self.streaming = streaming
+        self.use_mmap = use_mmap
+        self.segments_n = segments_n
+        self.segment_min_size = segment_min_size
+        self.pool_size = pool_size
+        self.cookie_jar = requests.cookies.RequestsCookieJar()
+        self._adapters = []
+        self._thread_local = threading.local()
+        self._segment_executor = None
+        self._segment_executor_lock = threading.Lock()
         self.queue = Queue()
         self.timeout = timeout
         self.name = name or self.__class__.__name__
         self.logger = get_logger('.'.join((__name__, self.name)), fmt=LOG_FMT_MESSAGE_ONLY)
-        self.recv_size_queue = Queue()
-        self.bytes_per_sec = 0
         self.emergency_queue = Queue()
         self.show_status_interval = 2
         self.show_status_enable = show_status
-        thread_factory(daemon=True)(self.calc_speed).start()
+        self.status_jsonl = open(status_jsonl, 'a', encoding='utf8', buffering=1) if status_jsonl else None
+        self.meter = ThroughputMeter(self.show_status_interval)
+        self.host_meters: T.Dict[str, ThroughputMeter] = {}
+        self.file_meters: T.Dict[str, T.Tuple[ThroughputMeter, int]] = {}
         thread_factory(daemon=True)(self.show_status).start()
         super().__init__(max_workers=threads_n)
 
@@ -349,6 +513,8 @@ class DownloadPool(ThreadPoolExecutor):
                 # preamble = shutil.get_terminal_size()[0] - status_width - 1
                 # print(' ' * preamble + status_msg, end='\r', file=sys.stderr)
                 print(status_msg, end='\r', file=sys.stderr)
+            if self.status_jsonl:
+                self.status_jsonl.write(json.dumps(self.status()) + '\n')
             if not eq.empty():
                 e = eq.get()
                 if isinstance(e, Exception):
@@ -356,64 +522,156 @@ class DownloadPool(ThreadPoolExecutor):
                     raise e
             sleep(self.show_status_interval)
 
+    @property
+    def bytes_per_sec(self):
+        return int(self.meter.bytes_per_sec)
+
     @property
     def speed(self):
         return human_filesize(self.bytes_per_sec, no_space=False) + '/s'
 
-    def calc_speed(self):
-        tl = []
-        nl = []
-        q = self.recv_size_queue
-        while True:
-            if q.empty():
-                sleep(0.5)
-                # print('DEBUG')
-                continue
-            t, n = q.get()
-            tl.append(t)
-            nl.append(n)
-            try:
-                self.bytes_per_sec = sum(nl) // (tl[-1] - tl[0])
-            except ZeroDivisionError:
-                self.bytes_per_sec = 0
-            while time.time() - tl[0] > self.show_status_interval:
-                tl.pop(0)
-                nl.pop(0)
+    def count_recv(self, url, filepath, n: int):
+        self.meter.add(n)
+        host = urlparse(url).netloc
+        try:
+            self.host_meters[host].add(n)
+        except KeyError:
+            self.host_meters.setdefault(host, ThroughputMeter(self.show_status_interval)).add(n)
+        try:
+            self.file_meters[filepath][0].add(n)
+        except KeyError:
+            pass
+
+    def track_file(self, filepath, size: int):
+        self.file_meters.setdefault(filepath, (ThroughputMeter(self.show_status_interval), size))
+
+    def untrack_file(self, filepath):
+        self.file_meters.pop(filepath, None)
+
+    def status(self) -> dict:
+        files = []
+        remaining = 0
+        for filepath, (meter, size) in list(self.file_meters.items()):
+            file_remaining = size - meter.total if size >= 0 else -1
+            if remaining >= 0:
+                remaining = remaining + file_remaining if file_remaining >= 0 else -1
+            files.append({'file': filepath, 'size': size, 'recv': meter.total,
+                          'bytes_per_sec': meter.bytes_per_sec, 'eta': meter.eta(file_remaining)})
+        return {'time': time.time(), 'name': self.name,
+                'threads': len(self._threads), 'max_workers': self._max_workers,
+                'bytes_per_sec': self.meter.bytes_per_sec, 'recv': self.meter.total,
+                'eta': self.meter.eta(remaining) if files else 0,
+                'hosts': {host: meter.bytes_per_sec for host, meter in list(self.host_meters.items())},
+                'connections': self.connection_stats,
+                'files': files}
+
+    @property
+    def session(self) -> requests.Session:
+        """keep-alive session of current worker thread, all sessions share one cookie jar"""
+        local = self._thread_local
+        try:
+            return local.session
+        except AttributeError:
+            session = requests.Session()
+            session.cookies = self.cookie_jar
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._adapters.append(adapter)
+            local.session = session
+            return session
+
+    @property
+    def connection_stats(self) -> dict:
+        """count of requests and of new connections in all sessions, and the ratio of reused connections"""
+        requests_n = connections_n = 0
+        for adapter in list(self._adapters):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_n += pool.num_requests
+                connections_n += pool.num_connections
+        reuse_rate = 1 - connections_n / requests_n if requests_n else 0
+        return {'requests': requests_n, 'connections': connections_n, 'reuse_rate': reuse_rate}
 
     def parse_head(self, url, **kwargs_for_requests):
-        head = requests.head(url, **kwargs_for_requests).headers
-        split = head.pop('accept-range') == 'bytes'
-        size = int(head.pop('content-length', '-1'))
+        kwargs = make_requests_kwargs(**kwargs_for_requests)
+        head = self.session.head(url, allow_redirects=True, timeout=self.timeout, **kwargs).headers
+        split = head.get('accept-ranges') == 'bytes'
+        size = int(head.get('content-length', '-1'))
         self.logger.debug('HEAD: split={}, size={}'.format(split, size))
 
         return {'split': split, 'size': size}
 
-    def request_data(self, url, filepath, start=0, stop=0, **kwargs_for_requests) -> Download:
-        # chunk_size = requests.models.CONTENT_CHUNK_SIZE
-        chunk_size = 4096 * 1024
-        kwargs = make_requests_kwargs(**kwargs_for_requests)
+    @staticmethod
+    def set_range_header(kwargs_for_requests: dict, start=0, stop=0):
         if stop:
-            kwargs['headers']['Range'] = 'bytes={}-{}'.format(start, stop - 1)
+            kwargs_for_requests['headers']['Range'] = 'bytes={}-{}'.format(start, stop - 1)
         elif start > 0:
-            kwargs['headers']['Range'] = 'bytes={}-'.format(start)
+            kwargs_for_requests['headers']['Range'] = 'bytes={}-'.format(start)
         elif start < 0:
-            kwargs['headers']['Range'] = 'bytes={}'.format(start)
-        r = requests.get(url, stream=True, timeout=self.timeout, **kwargs)
-        self.logger.debug(HTTPResponseInspection(r, no_content=True))
+            kwargs_for_requests['headers']['Range'] = 'bytes={}'.format(start)
+        return kwargs_for_requests
 
-        content = b''
-        stop = 0
-        for chunk in r.iter_content(chunk_size=chunk_size):
-            self.recv_size_queue.put((time.time(), len(chunk)))
-            start = stop
-            stop = start + len(chunk)
-            content += chunk
-            total = len(content)
-            fstk.write_file_chunk(filepath, start, stop, chunk, total)
-        self.logger.debug(HTTPResponseInspection(r, content=content))
+    def request_data(self, url, filepath, start=0, stop=0, **kwargs_for_requests) -> Download:
+        # chunk_size = requests.models.CONTENT_CHUNK_SIZE
+        kwargs = self.set_range_header(make_requests_kwargs(**kwargs_for_requests), start, stop)
+        r = self.session.get(url, stream=True, timeout=self.timeout, **kwargs)
+        self.logger.debug(HTTPResponseInspection(r, no_content=True))
+        self.track_file(filepath, int(r.headers.get('Content-Length', '-1')))
+
+        content = bytearray()
+        for chunk in r.iter_content(chunk_size=self.chunk_size):
+            self.count_recv(url, filepath, len(chunk))
+            content.extend(chunk)
+        content = bytes(content)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(HTTPResponseInspection(r, content=content))
         d = Download(r, filepath, content=content)
         return d
 
+    def request_data_to_file(self, url, filepath, start=0, stop=0, **kwargs_for_requests) -> Download:
+        """stream response body into `filepath` at its own offset, through one open file handle"""
+        kwargs = self.set_range_header(make_requests_kwargs(**kwargs_for_requests), start, stop)
+        r = self.session.get(url, stream=True, timeout=self.timeout, **kwargs)
+        self.logger.debug(HTTPResponseInspection(r, no_content=True))
+        if not r.ok:
+            raise HTTPResponseInspection(r)
+
+        content_length = int(r.headers.get('Content-Length', '-1'))
+        if r.status_code == 206:
+            offset, _, total = [int(s) for s in re.search(r'(\d+)-(\d+)/(\d+)', r.headers['Content-Range']).groups()]
+        else:
+            offset, total = 0, content_length
+        self.track_file(filepath, total)
+        recv_size = 0
+        with open(filepath, 'rb+') as f:
+            if total >= 0 and os.fstat(f.fileno()).st_size != total:
+                f.truncate(total)
+            if self.use_mmap and total > 0:
+                import mmap
+                with mmap.mmap(f.fileno(), total) as m:
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        n = len(chunk)
+                        self.count_recv(url, filepath, n)
+                        pos = offset + recv_size
+                        if pos + n > total:
+                            raise HTTPIncomplete(total - offset, recv_size + n)
+                        m[pos:pos + n] = chunk
+                        recv_size += n
+                    m.flush()
+            else:
+                f.seek(offset)
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    self.count_recv(url, filepath, len(chunk))
+                    f.write(chunk)
+                    recv_size += len(chunk)
+        d = Download(r, filepath, no_content=True, size=recv_size)
+        self.logger.debug('w {} ({}) <- {}'.format(filepath, human_filesize(recv_size), url))
+        return d
+
     def write_file(self, dl_obj: Download):
         url = dl_obj.url
         file = dl_obj.file
@@ -427,36 +685,99 @@ class DownloadPool(ThreadPoolExecutor):
             f[start: stop] = dl_obj.data
             self.logger.debug('w {} ({}) <- {}'.format(file, human_filesize(size), url))
 
-    def download(self, url, filepath, retry, **kwargs_for_requests):
-        tmpfile = filepath + self.tmpfile_suffix
-        fstk.touch(tmpfile)
-        for cnt, x in iter_factory_retry(retry)(self.request_data, url, tmpfile, **kwargs_for_requests):
+    def call_retry(self, retry, url, filepath, callee, *args, **kwargs):
+        for cnt, x in iter_factory_retry(retry)(callee, *args, **kwargs):
             if isinstance(x, Exception):
                 self.logger.warning('! <{}> {}'.format(type(x).__name__, x))
                 # self.logger.warning(''.join(traceback.format_tb(x.__traceback__)))
                 if cnt:
                     self.logger.info('++ retry ({}) {} <- {}'.format(cnt, filepath, url))
             else:
-                dl_obj = x
-                break
-        else:
+                return x
+
+    def download(self, url, filepath, retry, **kwargs_for_requests):
+        if self.segments_n > 1:
+            try:
+                head = self.parse_head(url, **kwargs_for_requests)
+            except Exception as e:
+                self.logger.warning('! <{}> {}'.format(type(e).__name__, e))
+            else:
+                if head['split'] and head['size'] >= self.segment_min_size:
+                    return self.download_segmented(url, filepath, retry, head['size'], **kwargs_for_requests)
+        tmpfile = filepath + self.tmpfile_suffix
+        fstk.touch(tmpfile)
+        request = self.request_data_to_file if self.streaming else self.request_data
+        dl_obj = self.call_retry(retry, url, filepath, request, url, tmpfile, **kwargs_for_requests)
+        self.untrack_file(tmpfile)
+        if not dl_obj:
             return
-        self.write_file(dl_obj)
+        if not self.streaming:
+            self.write_file(dl_obj)
         os.rename(tmpfile, filepath)
         self.log_file_done(filepath, dl_obj.size)
 
-    def log_file_done(self, filepath, size):
-        self.logger.info('* {} ({})'.format(filepath, human_filesize(size)))
-
-    def file_already_exists(self, filepath):
-        if os.path.isfile(filepath):
-            self.logger.info('# {}'.format(filepath))
-            return True
-        else:
-            return False
+    def download_segmented(self, url, filepath, retry, size, **kwargs_for_requests):
+        """preallocate the temp file, then download every missing byte range in the private segment executor,
+        and wait for them in this worker, the last finished range renames the temp file"""
+        tmpfile = filepath + self.tmpfile_suffix
+        progress_file = tmpfile + self.progress_file_suffix
+        if os.path.isfile(progress_file) and not (os.path.isfile(tmpfile) and os.path.getsize(tmpfile) == size):
+            self.logger.debug('discard stale {}'.format(progress_file))
+            os.remove(progress_file)
+        fstk.touch(tmpfile)
+        with open(tmpfile, 'rb+') as f:
+            if os.fstat(f.fileno()).st_size != size:
+                f.truncate(size)
+        segments = DownloadSegments(progress_file, size, self.segments_n)
+        missing = segments.missing
+        self.track_file(tmpfile, sum(stop - start for _, start, stop in missing))
+        if not missing:
+            return self.finish_segmented(filepath, segments)
+        self.logger.debug('{} segments of {} to download: {}'.format(len(missing), filepath, missing))
+        executor = self.segment_executor
+        futures = [executor.submit(self.download_segment, url, filepath, retry, segments, i, start, stop,
+                                   **kwargs_for_requests) for i, start, stop in missing]
+        for future in futures:
+            future.result()
 
-    def log_new_download(self, url, filepath, retry):
-        self.logger.info('+ {} <- {} (retry={})'.format(filepath, url, retry))
+    @property
+    def segment_executor(self) -> ThreadPoolExecutor:
+        """threads for byte ranges, apart from the pool itself, so a worker could wait for the ranges of its file
+        without taking pool slots, and the ranges still run after the pool stopped taking new jobs"""
+        with self._segment_executor_lock:
+            if not self._segment_executor:
+                self._segment_executor = ThreadPoolExecutor(self._max_workers * self.segments_n,
+                                                            thread_name_prefix=self.name + '-segment')
+            return self._segment_executor
+
+    def shutdown(self, wait=True, **kwargs):
+        super().shutdown(wait=wait, **kwargs)
+        if self._segment_executor:
+            self._segment_executor.shutdown(wait=wait)
+
+    def request_segment(self, url, filepath, start, stop, **kwargs_for_requests):
+        dl_obj = self.request_data_to_file(url, filepath, start, stop, **kwargs_for_requests)
+        if (dl_obj.start, dl_obj.stop) != (start, stop):
+            raise HTTPIncomplete(stop - start, dl_obj.size)
+        return dl_obj
+
+    def download_segment(self, url, filepath, retry, segments: DownloadSegments, index, start, stop,
+                         **kwargs_for_requests):
+        tmpfile = filepath + self.tmpfile_suffix
+        dl_obj = self.call_retry(retry, url, filepath, self.request_segment, url, tmpfile, start, stop,
+                                 **kwargs_for_requests)
+        if segments.finish(index, bool(dl_obj)):
+            self.finish_segmented(filepath, segments)
+
+    def finish_segmented(self, filepath, segments: DownloadSegments):
+        self.untrack_file(filepath + self.tmpfile_suffix)
+        if not segments.is_complete:
+            self.logger.warning('! {} segment(s) failed, run again to resume: {}'.format(
+                len(segments.failed), filepath))
+            return
+        os.rename(filepath + self.tmpfile_suffix, filepath)
+        segments.remove()
+        self.log_file_done(filepath, segments.size)
 
     def submit_download(self, url, filepath, retry, **kwargs_for_requests):
         if self.file_already_exists(filepath):
@@ -465,18 +786,241 @@ class DownloadPool(ThreadPoolExecutor):
         self.log_new_download(url, filepath, retry)
         return future
 
-    def put_download_in_queue(self, url, filepath, retry, **kwargs_for_requests):
+    def start_queue_loop(self):
+        thread_factory()(self.queue_pipeline).start()
+
+
+class TokenBucket:
+    """rate limiter for threads, `rate` tokens refill per second, up to `capacity` tokens could be used in a burst"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n: float = 1):
+        """take `n` tokens, block until they are refilled if the bucket runs short"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            sleep(wait)
+
+
+class JSONResponseCache:
+    """JSON responses of GET requests cached as files in a folder, revalidated by ETag / Last-Modified"""
+
+    def __init__(self, folder: str, max_age: float = 0):
+        """`max_age`: seconds to trust a cached response without asking the server at all"""
+        self.folder = folder
+        self.max_age = max_age
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, url, params: dict = None):
+        key = url + '?' + urllib.parse.urlencode(sorted(params.items())) if params else url
+        return os.path.join(self.folder, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def load(self, url, params: dict = None) -> dict or None:
+        """{'time': ..., 'etag': ..., 'last_modified': ..., 'data': ...} or None"""
+        try:
+            with open(self.path(url, params), encoding='utf8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, url, params: dict, entry: dict):
+        path = self.path(url, params)
+        tmp = f'{path}.{threading.get_ident()}'
+        with open(tmp, 'w', encoding='utf8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def get(self, session: requests.Session, url, params: dict = None, max_age: float = None, **kwargs_for_requests):
+        """parsed JSON, from the cache if it is younger than `max_age` or the server says not modified"""
+        max_age = self.max_age if max_age is None else max_age
+        entry = self.load(url, params)
+        if entry and time.time() - entry['time'] < max_age:
+            return entry['data']
+        headers = dict(kwargs_for_requests.pop('headers', None) or {})
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        r = session.get(url, params=params, headers=headers, **kwargs_for_requests)
+        if r.status_code == 304 and entry:
+            entry['time'] = time.time()
+            self.save(url, params, entry)
+            return entry['data']
+        if not r.ok or r.status_code == 304:
+            raise HTTPResponseInspection(r)
+        data = r.json()
+        self.save(url, params, {'time': time.time(), 'etag': r.headers.get('ETag'),
+                                'last_modified': r.headers.get('Last-Modified'), 'data': data})
+        return data
+
+
+class AsyncTokenBucket:
+    """bandwidth limiter for coroutines, `rate` tokens (bytes) refill per second"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+
+    async def consume(self, n: int):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+        self.tokens -= n
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class AsyncDownloadPool(DownloadPoolMixin):
+    """asyncio downloader with the same interface as `DownloadPool`, for jobs of many small files
+
+    an event loop runs in a daemon thread, `submit_download` returns a `concurrent.futures.Future`
+    it needs `aiohttp`"""
+    chunk_size = 4096 * 1024
+    retry_delay = 1
+    retry_delay_max = 60
+
+    def __init__(self, concurrency: int = 100, per_host: int = 8, max_bytes_per_sec: int = 0,
+                 timeout: int = 30, name: str = None):
+        """`concurrency`: max concurrent fetches in total
+        `per_host`: max concurrent connections to one host
+        `max_bytes_per_sec`: global bandwidth cap, 0 means no limit"""
+        import aiohttp
+        self._aiohttp = aiohttp
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.name = name or self.__class__.__name__
+        self.logger = get_logger('.'.join((__name__, self.name)), fmt=LOG_FMT_MESSAGE_ONLY)
+        self.queue = Queue()
+        self.meter = ThroughputMeter()
+        self.bandwidth = AsyncTokenBucket(max_bytes_per_sec) if max_bytes_per_sec else None
+        self.futures = set()
+        self._session = None
+        self._semaphore = None
+        self.loop = asyncio.new_event_loop()
+        thread_factory(daemon=True)(self.loop.run_forever).start()
+
+    @property
+    def speed(self):
+        return human_filesize(int(self.meter.bytes_per_sec), no_space=False) + '/s'
+
+    def get_session(self):
+        """must be called inside the event loop"""
+        if not self._session:
+            aiohttp = self._aiohttp
+            connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.timeout, sock_read=self.timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    @staticmethod
+    def make_aiohttp_kwargs(url, **kwargs_for_requests):
+        kwargs = make_requests_kwargs(**kwargs_for_requests)
+        proxies = kwargs.pop('proxies', None)
+        if proxies:
+            kwargs['proxy'] = proxies.get(urlparse(url).scheme)
+        kwargs.pop('timeout', None)
+        return kwargs
+
+    async def request_data_to_file(self, url, filepath, **kwargs_for_requests) -> int:
+        """stream response body into `filepath`, return size, same checks as `Download`"""
+        session = self.get_session()
+        async with self._semaphore:
+            async with session.get(url, **self.make_aiohttp_kwargs(url, **kwargs_for_requests)) as r:
+                if not r.ok:
+                    raise HTTPResponseInspection.from_aiohttp(r, await r.content.read(4096))
+                content_length = int(r.headers.get('Content-Length', '-1'))
+                recv_size = 0
+                buffer = bytearray()
+                with open(filepath, 'wb') as f:
+                    async for chunk in r.content.iter_chunked(self.chunk_size):
+                        n = len(chunk)
+                        if self.bandwidth:
+                            await self.bandwidth.consume(n)
+                        self.meter.add(n)
+                        recv_size += n
+                        buffer.extend(chunk)
+                        if len(buffer) >= self.chunk_size:
+                            await asyncio.to_thread(f.write, bytes(buffer))
+                            buffer.clear()
+                    if buffer:
+                        await asyncio.to_thread(f.write, bytes(buffer))
+        if content_length >= 0 and content_length != recv_size:
+            raise HTTPIncomplete(content_length, recv_size)
+        return recv_size
+
+    async def download(self, url, filepath, retry, **kwargs_for_requests):
+        """4xx responses are not retried, other errors are retried after a doubling delay (up to `retry_delay_max`)"""
+        tmpfile = filepath + self.tmpfile_suffix
+        cnt = retry + 1 if retry >= 0 else -1
+        delay = self.retry_delay
+        while cnt:
+            try:
+                size = await self.request_data_to_file(url, tmpfile, **kwargs_for_requests)
+            except Exception as e:
+                cnt -= 1
+                self.logger.warning('! <{}> {}'.format(type(e).__name__, e))
+                if isinstance(e, HTTPResponseInspection) and e.is_client_error:
+                    break
+                if cnt:
+                    self.logger.info('++ retry ({}) {} <- {}'.format(cnt, filepath, url))
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.retry_delay_max)
+            else:
+                os.replace(tmpfile, filepath)
+                self.log_file_done(filepath, size)
+                return size
+
+    def schedule_download(self, url, filepath, retry, **kwargs_for_requests):
+        future = asyncio.run_coroutine_threadsafe(self.download(url, filepath, retry, **kwargs_for_requests),
+                                                  self.loop)
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return future
+
+    def submit_download(self, url, filepath, retry, **kwargs_for_requests):
         if self.file_already_exists(filepath):
             return
-        self.queue.put((url, filepath, retry, kwargs_for_requests))
+        future = self.schedule_download(url, filepath, retry, **kwargs_for_requests)
         self.log_new_download(url, filepath, retry)
+        return future
 
-    def put_end_of_queue(self):
-        self.queue.put(None)
+    def queue_pipeline(self):
+        self.logger.debug('queue of {} started'.format(self))
+        q = self.queue
+        while True:
+            args = q.get()
+            if args is None:
+                break
+            url, filepath, retry, kwargs_for_requests = args
+            self.schedule_download(url, filepath, retry, **kwargs_for_requests)
+            self.logger.debug('submit {}'.format(filepath))
+        self.logger.debug('queue of {} stopped'.format(self))
 
     def start_queue_loop(self):
         thread_factory()(self.queue_pipeline).start()
 
+    def shutdown(self, wait=True):
+        if wait:
+            while self.futures:
+                concurrent.futures.wait(list(self.futures))
+        if self._session:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
 
 def parse_https_url(url: str, allow_fragments=True) -> ParseResult:
     test_parse = urlparse(url)
@@ -103,19 +103,94 @@ def cwebp_call(src: T.Union[str, bytes], dst: T.Union[str, bool, T.NoneType, T.E
     return rj
 
 
-def cwebp(src: T.Union[str, bytes], dst: T.Union[str, bool, T.NoneType, T.EllipsisType] = ..., **kwargs):
-    rj = cwebp_call(src, dst, **kwargs)
+def psnr_of_images(a: Image.Image, b: Image.Image):
+    """PSNR (dB) of two same-size images, over all channels"""
+    import numpy as np
+    diff = np.subtract(np.asarray(a), np.asarray(b), dtype=np.int16)
+    mse = float(np.square(diff, dtype=np.float64).mean())
+    return 99.0 if mse == 0 else round(10 * math.log10(255 ** 2 / mse), 2)
+
+
+def pillow_webp_call(src: T.Union[str, bytes], dst: T.Union[str, bool, T.NoneType, T.EllipsisType] = ...,
+                     image: Image.Image = None, **kwargs):
+    """in-process counterpart of `cwebp_call` via Pillow (libwebp), return a result dict of the same shape
+
+    support `q`, `resize` (scale or (w, h)), `m` and `lossless`, anything else (e.g. `size`) goes to `cwebp_call`
+    `image` is the already decoded `src`, pass it to skip decoding `src` again and again"""
+    if set(kwargs) - {'q', 'resize', 'm', 'lossless'}:
+        return cwebp_call(src, dst, **kwargs)
+    if isinstance(src, str):
+        src_size = os.path.getsize(src)
+        src_data = {'path': src, 'size': src_size}
+    elif isinstance(src, bytes):
+        src_size = len(src)
+        src_data = {'path': '-', 'size': src_size}
+    else:
+        raise TypeError('src', (str, bytes))
+    if dst is ...:
+        dst = src + '.webp'
+    rj = {'kwargs': kwargs, 'out': b'', 'msg': [], 'cmd': None, 'code': 0, 'ok': True, 'src': src_data}
+
+    try:
+        if image is None:
+            image = open_bytes_as_image(src) if isinstance(src, bytes) else Image.open(src)
+        image.load()
+    except Exception as e:
+        rj.update(msg=[f'Input file read error: {e!r}', 'Error! Cannot read input picture file'], code=255, ok=False)
+        return rj
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+    dst_data = {}
+    if 'q' in kwargs:
+        dst_data['q'] = float(kwargs['q'])
+    resize = kwargs.get('resize')
+    w, h = image.size
+    if isinstance(resize, (int, float)) and resize > 0 and resize != 1:
+        src_data['width'] = w
+        src_data['height'] = h
+        dst_data['scale'] = resize
+        image = image.resize((round(w * resize), round(h * resize)), Image.LANCZOS)
+    elif isinstance(resize, (tuple, list)):
+        image = image.resize(tuple(resize), Image.LANCZOS)
+
+    out = save_image_to_bytes(image, 'WEBP', quality=kwargs.get('q', 75), method=kwargs.get('m', 4),
+                              lossless=bool(kwargs.get('lossless')))
+    decoded = open_bytes_as_image(out)
+    if decoded.mode != image.mode:
+        decoded = decoded.convert(image.mode)
+    dst_data.update({'width': image.width, 'height': image.height, 'size': len(out),
+                     'psnr': {'all': psnr_of_images(image, decoded)}})
+    dst_data['compress'] = round(dst_data['size'] / src_size, 3)
+    if dst == '-':
+        rj['out'] = out
+    elif dst:
+        with open(dst, 'wb') as f:
+            f.write(out)
+        dst_data['path'] = dst
+    rj['dst'] = dst_data
+    return rj
+
+
+BACKENDS = {'cli': cwebp_call, 'pillow': pillow_webp_call}
+
+
+def cwebp(src: T.Union[str, bytes], dst: T.Union[str, bool, T.NoneType, T.EllipsisType] = ..., backend='cli',
+          **kwargs):
+    call = BACKENDS[backend]
+    rj = call(src, dst, **kwargs)
     try:
         return check_cwebp_call_result(rj)
     except CWebpInputReadError as e:
         # if {'Corrupt JPEG data: premature end of data segment', 'Bogus marker length'} & set(rj['msg']):
+        kwargs.pop('image', None)
         try:
             enable_load_truncated_image()
             if isinstance(src, bytes):
                 img = open_bytes_as_image(src)
             else:
                 img = Image.open(src)
-            return check_cwebp_call_result(cwebp_call(save_image_to_bytes(img, 'PNG'), dst, **kwargs))
+            return check_cwebp_call_result(call(save_image_to_bytes(img, 'PNG'), dst, **kwargs))
         except Exception:
             raise e
 
@@ -167,11 +242,27 @@ def check_cwebp_call_result(result: dict):
     return result
 
 
+def _decode_once_for_backend(src, backend):
+    if backend != 'pillow':
+        return {'backend': backend}
+    try:
+        image = open_bytes_as_image(src) if isinstance(src, bytes) else Image.open(src)
+        image.load()
+    except Exception:
+        return {'backend': backend}  # let `cwebp` deal with the bad input
+    return {'backend': backend, 'image': image}
+
+
 def cwebp_adaptive_gen___alpha(src, max_size: int, max_compress: float, max_q: int, min_q: int, min_scale: float,
-                               *, q_step=5, scale_step=0.05):
+                               *, q_step=5, scale_step=0.05, stats: dict = None, backend='cli'):
     q_step_by_100 = q_step / 100
+    stats = {} if stats is None else stats
+    stats.setdefault('encodes', 0)
+    _cwebp_kw = _decode_once_for_backend(src, backend)
 
-    _cwebp = partial(cwebp, src, '-')
+    def _cwebp(**kwargs):
+        stats['encodes'] += 1
+        return cwebp(src, '-', **_cwebp_kw, **kwargs)
 
     def calc_dst_size_compress_divided_by_max(cwebp_data: dict):
         o_size = cwebp_data['dst']['size']
@@ -231,3 +322,92 @@ def cwebp_adaptive_gen___alpha(src, max_size: int, max_compress: float, max_q: i
     else:
         yield _cwebp(resize=scale, size=max_size)
         return
+
+
+def cwebp_adaptive_gen_proxy___alpha(src, max_size: int, max_compress: float, max_q: int, min_q: int,
+                                     min_scale: float, *, q_step=5, scale_step=0.05, proxy_pixels=256 * 1024,
+                                     stats: dict = None, backend='cli'):
+    """same goal as `cwebp_adaptive_gen___alpha`, but with far less full-size encodes
+
+    encode a downscaled proxy of the image at min/mid/max q, model full-size output size as
+    proxy size * (scale ** 2 / proxy scale ** 2) interpolated over q, pick the best (q, scale) from the model,
+    then encode the real image once, correct the model by the real size and encode once more if needed
+    an image no larger than `proxy_pixels` has no smaller proxy, so it goes through `cwebp_adaptive_gen___alpha`
+    `stats` (if given) records 'encodes' (full-size) and 'proxy_encodes'"""
+    stats = {} if stats is None else stats
+    stats.setdefault('encodes', 0)
+    stats.setdefault('proxy_encodes', 0)
+    w, h = (open_bytes_as_image(src) if isinstance(src, bytes) else Image.open(src)).size
+    proxy_scale = min(1., math.sqrt(proxy_pixels / (w * h)))
+    if proxy_scale == 1:
+        yield from cwebp_adaptive_gen___alpha(src, max_size, max_compress, max_q, min_q, min_scale, q_step=q_step,
+                                              scale_step=scale_step, stats=stats, backend=backend)
+        return
+    _cwebp_kw = _decode_once_for_backend(src, backend)
+
+    def _cwebp(**kwargs):
+        stats['encodes'] += 1
+        return cwebp(src, '-', **_cwebp_kw, **kwargs)
+
+    img = _cwebp_kw['image'] if 'image' in _cwebp_kw else (
+        open_bytes_as_image(src) if isinstance(src, bytes) else Image.open(src))
+    src_size = len(src) if isinstance(src, bytes) else os.path.getsize(src)
+    budget = min(max_size, max_compress * src_size)
+    proxy_img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB').resize(
+        (max(1, round(w * proxy_scale)), max(1, round(h * proxy_scale))), Image.BILINEAR)
+    proxy_src = save_image_to_bytes(proxy_img, 'PNG', compress_level=1)
+    proxy_kw = {'image': proxy_img} if backend == 'pillow' else {}
+    q_points = sorted({min_q, (min_q + max_q) // 2, max_q})
+    proxy_sizes = []
+    for q in q_points:
+        stats['proxy_encodes'] += 1
+        proxy_sizes.append(cwebp(proxy_src, '-', backend=backend, **proxy_kw, q=q)['dst']['size'])
+
+    def predict(q, scale, correction=1.):
+        i = max(0, min(len(q_points) - 2, sum(1 for x in q_points[1:-1] if x <= q)))
+        if len(q_points) == 1:
+            size = proxy_sizes[0]
+        else:
+            q0, q1 = q_points[i], q_points[i + 1]
+            s0, s1 = math.log(proxy_sizes[i]), math.log(proxy_sizes[i + 1])
+            size = math.exp(s0 + (s1 - s0) * (q - q0) / (q1 - q0))
+        return size * scale ** 2 / proxy_scale ** 2 * correction
+
+    def candidates():
+        q = max_q
+        while q >= min_q:
+            scale = 1.
+            while scale >= min_scale - 1e-9:
+                yield q, round(scale, 2)
+                scale = round_to(scale - scale_step, scale_step)
+            q -= q_step
+
+    def choose(correction):
+        for q, scale in candidates():
+            if predict(q, scale, correction) <= budget:
+                return q, scale
+
+    def fits(d):
+        return d['dst']['size'] <= max_size and d['dst']['compress'] <= max_compress
+
+    q, scale = choose(1.) or (min_q, min_scale)
+    logger.debug(f'proxy estimate: q={q}, scale={scale}')
+    d = _cwebp(resize=scale, q=q)
+    yield d
+    better = choose(d['dst']['size'] / predict(q, scale))
+    if fits(d):
+        if not better or (-better[0], -better[1]) >= (-q, -scale):
+            return
+        d2 = _cwebp(resize=better[1], q=better[0])
+        yield d2
+        if not fits(d2):
+            yield d
+        return
+    if better and better != (q, scale):
+        d = _cwebp(resize=better[1], q=better[0])
+        yield d
+        if fits(d):
+            return
+    if max_size / src_size > max_compress:
+        raise SkipOverException('modest file size, keep original')
+    yield _cwebp(resize=min_scale, size=max_size)